@@ -0,0 +1,113 @@
+"""Connect/disconnect churn in ConnectionManager at 50k concurrent users.
+
+Fills the manager with USERS connected users, each a member of
+ROOMS_PER_USER rooms drawn from ROOMS conversations. It then times a
+reconnect storm: CHURN users disconnect and reconnect. The same disconnects
+are also timed with the old cleanup, which scanned every room.
+
+Run from the repository root (needs the app's environment variables, the
+database is not touched):
+
+    python benchmarks/bench_connection_churn.py
+"""
+import asyncio
+import builtins
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.websocket.websocket_manager import ConnectionManager  # noqa: E402
+from src.websocket.backplane import LocalBackplane  # noqa: E402
+
+
+USERS = 50_000
+ROOMS = 100_000
+ROOMS_PER_USER = 20
+CHURN = 5_000
+LEGACY_SAMPLE = 200
+MEMORY_SAMPLE = 5_000
+
+
+class FakeWebSocket:
+    async def accept(self):
+        pass
+    
+    async def send_text(self, frame):
+        pass
+    
+    async def close(self, code=1000):
+        pass
+
+
+def new_manager() -> ConnectionManager:
+    manager = ConnectionManager()
+    manager.backplane = LocalBackplane(manager)
+    return manager
+
+
+async def connect(manager, user_id, rooms):
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, user_id)
+    for conversation_id in rooms:
+        manager.join_conversation(user_id, conversation_id)
+    return websocket
+
+
+def legacy_disconnect(manager, user_id):
+    """Pre-index cleanup: walk every room in the process"""
+    for room_users in manager.conversation_rooms.values():
+        room_users.discard(user_id)
+
+
+async def main():
+    random.seed(1)
+    rooms = [str(uuid.uuid4()) for _ in range(ROOMS)]
+    memberships = {str(uuid.uuid4()): random.sample(rooms, ROOMS_PER_USER) for _ in range(USERS)}
+    users = list(memberships)
+    manager = new_manager()
+    
+    # Connection logging would dominate the timings
+    print_ = builtins.print
+    builtins.print = lambda *a, **k: None
+    try:
+        sockets = {}
+        start = time.perf_counter()
+        for user_id in users:
+            sockets[user_id] = await connect(manager, user_id, memberships[user_id])
+        connect_s = time.perf_counter() - start
+        
+        storm = random.sample(users, CHURN)
+        start = time.perf_counter()
+        for user_id in storm:
+            manager.disconnect(sockets[user_id], user_id)
+            sockets[user_id] = await connect(manager, user_id, memberships[user_id])
+        churn_s = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for user_id in storm[:LEGACY_SAMPLE]:
+            legacy_disconnect(manager, user_id)
+        legacy_s = (time.perf_counter() - start) / LEGACY_SAMPLE
+        
+        # Traced separately, tracing slows everything down
+        sample = new_manager()
+        tracemalloc.start()
+        for user_id in users[:MEMORY_SAMPLE]:
+            await connect(sample, user_id, memberships[user_id])
+        memory = tracemalloc.get_traced_memory()[0] / MEMORY_SAMPLE
+        tracemalloc.stop()
+    finally:
+        builtins.print = print_
+    
+    print(f"{USERS} users, {len(manager.conversation_rooms)} live rooms, {ROOMS_PER_USER} rooms per user")
+    print(f"initial connect:         {connect_s * 1e6 / USERS:8.1f} us/user, {memory:6.0f} B/user traced")
+    print(f"disconnect + reconnect:  {churn_s * 1e6 / CHURN:8.1f} us/user ({CHURN} users)")
+    print(f"legacy full-scan cleanup:{legacy_s * 1e6:8.1f} us/user (disconnect only, {LEGACY_SAMPLE} users)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
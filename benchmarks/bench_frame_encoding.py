@@ -0,0 +1,64 @@
+"""Encode cost per broadcast event: one encode per socket vs. one shared frame.
+
+Run from the repository root:
+
+    python benchmarks/bench_frame_encoding.py
+"""
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.websocket.frames import encode_frame, orjson  # noqa: E402
+
+
+ROOM_SIZES = (10, 100, 1000)
+EVENTS = 200
+
+
+def sample_event() -> dict:
+    return {
+        "type": "new_message",
+        "data": {
+            "id": str(uuid.uuid4()),
+            "conversation_id": str(uuid.uuid4()),
+            "sender_id": str(uuid.uuid4()),
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4,
+            "message_type": "text",
+            "file_url": None,
+            "file_name": None,
+            "created_at": datetime.utcnow().isoformat(),
+            "sender": {"id": str(uuid.uuid4()), "username": "john_doe", "display_name": "John Doe"},
+        },
+    }
+
+
+def per_socket(event: dict, sockets: int):
+    # What Starlette's send_json does for every socket in the room
+    for _ in range(sockets):
+        json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+
+def shared_frame(event: dict, sockets: int):
+    frame = encode_frame(event)
+    for _ in range(sockets):
+        frame  # every socket gets the same str object
+
+
+def main():
+    event = sample_event()
+    backend = "orjson" if orjson is not None else "json"
+    print(f"encoder backend: {backend}, {EVENTS} events per measurement")
+    print(f"{'room':>6} {'per-socket us/event':>22} {'shared us/event':>18} {'speedup':>9}")
+    for sockets in ROOM_SIZES:
+        before = timeit.timeit(lambda: per_socket(event, sockets), number=EVENTS) / EVENTS * 1e6
+        after = timeit.timeit(lambda: shared_frame(event, sockets), number=EVENTS) / EVENTS * 1e6
+        print(f"{sockets:>6} {before:>22.1f} {after:>18.1f} {before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Query count and wall time for one 50-message history page.
+
+Compares the bulk-loading `get_all_messages` against the old per-message
+pattern (sender and receipts fetched per row, two Pydantic constructions per
+message). Needs DATABASE_URL / ASYNC_DATABASE_URL pointing at a database the
+app has already started against once; the rows it seeds are removed at exit.
+
+Run from the repository root:
+
+    python benchmarks/bench_message_history.py
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, select, delete  # noqa: E402
+
+from src.database.core import AsyncSessionLocal, async_engine  # noqa: E402
+from src.entities.users import User  # noqa: E402
+from src.entities.conversation import Conversation  # noqa: E402
+from src.entities.conversation_participant import ConversationParticipant  # noqa: E402
+from src.entities.message import Message  # noqa: E402
+from src.entities.message_read_receipt import MessageReadReceipt  # noqa: E402
+from src.message.models import MessageResponse  # noqa: E402
+from src.message.services import get_all_messages  # noqa: E402
+
+
+PAGE_SIZE = 50
+MEMBERS = 10
+ROUNDS = 20
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(async_engine.sync_engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+async def seed():
+    async with AsyncSessionLocal() as db:
+        suffix = uuid.uuid4().hex[:8]
+        users = [
+            User(username=f"bench_{suffix}_{i}", email=f"bench_{suffix}_{i}@example.com", hashed_password="x")
+            for i in range(MEMBERS)
+        ]
+        db.add_all(users)
+        conversation = Conversation(name="bench", is_group=True, created_by=users[0].id)
+        db.add(conversation)
+        await db.flush()
+        start = datetime.utcnow() - timedelta(hours=1)
+        db.add_all(
+            ConversationParticipant(conversation_id=conversation.id, user_id=u.id, last_read_at=datetime.utcnow())
+            for u in users
+        )
+        messages = [
+            Message(conversation_id=conversation.id, sender_id=users[i % MEMBERS].id,
+                    content=f"message {i}", created_at=start + timedelta(seconds=i))
+            for i in range(PAGE_SIZE)
+        ]
+        db.add_all(messages)
+        await db.flush()
+        db.add_all(
+            MessageReadReceipt(message_id=m.id, user_id=u.id)
+            for m in messages for u in users if u.id != m.sender_id
+        )
+        await db.commit()
+        return conversation.id, users
+
+
+async def cleanup(conversation_id, users):
+    async with AsyncSessionLocal() as db:
+        message_ids = select(Message.id).where(Message.conversation_id == conversation_id)
+        await db.execute(delete(MessageReadReceipt).where(MessageReadReceipt.message_id.in_(message_ids)))
+        await db.execute(delete(Message).where(Message.conversation_id == conversation_id))
+        await db.execute(delete(ConversationParticipant).where(ConversationParticipant.conversation_id == conversation_id))
+        await db.execute(delete(Conversation).where(Conversation.id == conversation_id))
+        await db.execute(delete(User).where(User.id.in_([u.id for u in users])))
+        await db.commit()
+
+
+async def per_message(conversation_id, db):
+    """The old shape: one query for the page plus two per message"""
+    messages = (await db.execute(
+        select(Message).where(Message.conversation_id == conversation_id, Message.is_deleted == False)
+        .order_by(Message.created_at.desc()).limit(PAGE_SIZE)
+    )).scalars().all()
+    result = []
+    for msg in messages:
+        sender = await db.scalar(select(User).where(User.id == msg.sender_id))
+        receipts = (await db.execute(
+            select(MessageReadReceipt).where(MessageReadReceipt.message_id == msg.id)
+        )).scalars().all()
+        msg_dict = MessageResponse.model_validate({**msg.__dict__, "sender": sender}).model_dump()
+        msg_dict["read_by"] = [r.user_id for r in receipts]
+        result.append(MessageResponse(**msg_dict))
+    return result
+
+
+async def bulk(conversation_id, user, db):
+    return (await get_all_messages(conversation_id, limit=PAGE_SIZE, current_user=user, db=db)).messages
+
+
+async def measure(label, counter, run):
+    queries = None
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        async with AsyncSessionLocal() as db:
+            before = counter.count
+            page = await run(db)
+            queries = counter.count - before
+    elapsed = (time.perf_counter() - start) / ROUNDS * 1000
+    assert len(page) == PAGE_SIZE
+    print(f"{label:<14}{queries:>10}{elapsed:>12.2f}")
+
+
+async def main():
+    conversation_id, users = await seed()
+    counter = QueryCounter()
+    try:
+        print(f"{PAGE_SIZE} messages, {MEMBERS} members, mean of {ROUNDS} rounds")
+        print(f"{'':<14}{'queries':>10}{'ms/page':>12}")
+        await measure("per-message", counter, lambda db: per_message(conversation_id, db))
+        await measure("bulk", counter, lambda db: bulk(conversation_id, users[0], db))
+    finally:
+        await cleanup(conversation_id, users)
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
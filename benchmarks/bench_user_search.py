@@ -0,0 +1,153 @@
+"""Latency of user search against a large users table.
+
+Seeds BENCH_USERS users (default 1,000,000) with COPY, then compares the old
+`LIKE '%q%'` lookup against the ranked, indexed `search_users` for a few query
+shapes, and measures loading and querying the in-process prefix index. Needs
+DATABASE_URL / ASYNC_DATABASE_URL pointing at a database the app has already
+started against once (so the search indexes exist); the rows it seeds are
+removed at exit. Substring queries only use an index when pg_trgm is installed.
+
+Run from the repository root:
+
+    python benchmarks/bench_user_search.py
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+from src.database.core import ASYNC_DATABASE_URL, AsyncSessionLocal, async_engine  # noqa: E402
+from src.entities.users import User  # noqa: E402
+from src.entities.conversation import Conversation  # noqa: E402,F401
+from src.entities.conversation_participant import ConversationParticipant  # noqa: E402,F401
+from src.entities.message import Message  # noqa: E402,F401
+from src.entities.message_read_receipt import MessageReadReceipt  # noqa: E402,F401
+from src.users.prefix_index import UserPrefixIndex  # noqa: E402
+from src.users.services import search_users  # noqa: E402
+
+
+USERS = int(os.getenv("BENCH_USERS", "1000000"))
+PAGE_SIZE = 20
+ROUNDS = 10
+FIRST_NAMES = [
+    "james", "mary", "robert", "patricia", "john", "jennifer", "michael", "linda", "david", "elizabeth",
+    "william", "barbara", "richard", "susan", "joseph", "jessica", "thomas", "sarah", "charles", "karen",
+    "maria", "marco", "martin", "mark", "aisha", "amir", "anna", "andre", "olga", "yuki"
+]
+LAST_NAMES = [
+    "smith", "johnson", "williams", "brown", "jones", "garcia", "miller", "davis", "rodriguez", "martinez",
+    "hernandez", "lopez", "gonzalez", "wilson", "anderson", "thomas", "taylor", "moore", "jackson", "martin",
+    "lee", "perez", "thompson", "white", "harris", "sanchez", "clark", "ramirez", "lewis", "robinson"
+]
+
+
+def make_users(tag: str):
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    for i in range(USERS):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = f"{first}{rng.choice(['', '.', '_'])}{last}{i}"
+        yield (
+            str(uuid.uuid4()), username, f"{username}@{tag}.bench", "x", f"{first.title()} {last.title()}",
+            False, True, 0, now, now
+        )
+
+
+async def seed(tag: str):
+    conn = await asyncpg.connect(ASYNC_DATABASE_URL)
+    try:
+        start = time.perf_counter()
+        async with conn.transaction():
+            # Seeding is not a profile change; keep a million notifications off the channel
+            await conn.execute("ALTER TABLE users DISABLE TRIGGER user_change_trigger")
+            await conn.copy_records_to_table("users", records=make_users(tag), columns=[
+                "id", "username", "email", "hashed_password", "display_name",
+                "is_online", "is_active", "token_version", "last_seen", "created_at"
+            ])
+            await conn.execute("ALTER TABLE users ENABLE TRIGGER user_change_trigger")
+        await conn.execute("ANALYZE users")
+        print(f"seeded {USERS} users in {time.perf_counter() - start:.1f}s")
+    finally:
+        await conn.close()
+
+
+async def cleanup(tag: str):
+    conn = await asyncpg.connect(ASYNC_DATABASE_URL)
+    try:
+        await conn.execute("DELETE FROM users WHERE email LIKE $1", f"%@{tag}.bench")
+    finally:
+        await conn.close()
+
+
+async def contains(query: str, db):
+    """The old shape: unanchored, case-sensitive LIKE on both columns"""
+    return (await db.execute(
+        select(User).where(User.is_active == True)
+        .where(User.username.contains(query) | User.display_name.contains(query)).limit(PAGE_SIZE)
+    )).scalars().all()
+
+
+async def ranked(query: str, db, pages: int = 1):
+    cursor = None
+    for _ in range(pages):
+        page = await search_users(query, PAGE_SIZE, cursor, User(id="bench"), db)
+        cursor = page.next_cursor
+    return page.users
+
+
+async def measure(run) -> float:
+    async with AsyncSessionLocal() as db:
+        await run(db)  # Warm up the connection and plan cache
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            await run(db)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+async def main():
+    tag = uuid.uuid4().hex[:8]
+    await seed(tag)
+    try:
+        cases = [
+            ("1-char prefix", "m"),
+            ("prefix", "mar"),
+            ("exact", "maria lopez"),
+            ("substring", "lopez12"),
+            ("no match", "zzqx"),
+        ]
+        print(f"mean of {ROUNDS} rounds, {PAGE_SIZE} results per page")
+        print(f"{'':<16}{'LIKE ms':>10}{'ranked ms':>12}{'page 5 ms':>12}")
+        for label, query in cases:
+            old = await measure(lambda db: contains(query, db))
+            new = await measure(lambda db: ranked(query, db))
+            deep = await measure(lambda db: ranked(query, db, pages=5)) / 5
+            print(f"{label:<16}{old:>10.2f}{new:>12.2f}{deep:>12.2f}")
+
+        index = UserPrefixIndex()
+        conn = await asyncpg.connect(ASYNC_DATABASE_URL)
+        try:
+            start = time.perf_counter()
+            await index.load(conn)
+            print(f"prefix index: loaded {len(index.users)} users in {time.perf_counter() - start:.1f}s")
+        finally:
+            await conn.close()
+        for label, query in cases[:3]:
+            start = time.perf_counter()
+            for _ in range(ROUNDS * 50):
+                index.search(query, PAGE_SIZE + 1, "bench")
+            print(f"prefix index {label:<16}{(time.perf_counter() - start) / (ROUNDS * 50) * 1000:>8.3f} ms")
+    finally:
+        await cleanup(tag)
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+"""Multi-process fan-out check for the Postgres backplane on one machine.
+
+Starts NODES uvicorn processes on consecutive ports, all with
+WS_BACKPLANE=postgres and their own NODE_ID, then:
+
+  * connects alice to node 0 and bob to node 1 (the last node hosts nobody),
+  * sends a typing frame and a message from alice over the socket,
+  * checks bob receives both across processes,
+  * checks from /metrics that the idle node received no backplane traffic,
+  * has alice type in HARNESS_ROOMS conversations shared with bob and as many
+    without him, and reports how much of the traffic node-1 got on its shard
+    channels was for rooms it does not host (the `filtered` counter).
+
+Needs the same environment as the app (DATABASE_URL, ASYNC_DATABASE_URL,
+SECRET_KEY, ALGORITHM) and the `websockets` client package. Run from the
+repository root:
+
+    python benchmarks/cluster_harness.py
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+import websockets
+from jose import jwt
+
+
+NODES = int(os.getenv("HARNESS_NODES", "3"))
+ROOMS = int(os.getenv("HARNESS_ROOMS", "100"))
+BASE_PORT = int(os.getenv("HARNESS_BASE_PORT", "8100"))
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_node(index: int) -> subprocess.Popen:
+    env = dict(os.environ, WS_BACKPLANE="postgres", NODE_ID=f"node-{index}")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(BASE_PORT + index), "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+
+
+def wait_ready(index: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{BASE_PORT + index}/").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"node {index} did not start")
+
+
+def token_for(user_id: str) -> str:
+    expire = datetime.utcnow() + timedelta(minutes=30)
+    return jwt.encode({"sub": user_id, "exp": expire}, os.environ["SECRET_KEY"], algorithm=os.environ["ALGORITHM"])
+
+
+async def receive_type(ws, event_type: str, timeout: float = 5) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), deadline - time.monotonic()))
+        if frame["type"] == event_type:
+            return frame
+
+
+WS_URL = "ws://127.0.0.1:{}/ws?token={}"
+
+
+def backplane_metrics() -> list:
+    return [httpx.get(f"http://127.0.0.1:{BASE_PORT + i}/metrics").json()["websocket"] for i in range(NODES)]
+
+
+async def create_conversation(client, ids: dict, creator: str, members: list) -> str:
+    r = await client.post(
+        "/conversations/", json={"participant_ids": [ids[m] for m in members], "is_group": True, "name": "harness"},
+        headers={"Authorization": f"Bearer {token_for(ids[creator])}"}
+    )
+    r.raise_for_status()
+    return r.json()["id"]
+
+
+async def scenario():
+    api = f"http://127.0.0.1:{BASE_PORT}"
+    suffix = uuid.uuid4().hex[:8]
+    async with httpx.AsyncClient(base_url=api) as client:
+        ids = {}
+        for name in ("alice", "bob", "carol"):
+            r = await client.post("/auth/register", json={
+                "username": f"{name}_{suffix}", "email": f"{name}_{suffix}@example.com", "password": "harness"
+            })
+            r.raise_for_status()
+            ids[name] = r.json()["user"]["id"]
+        conversation_id = await create_conversation(client, ids, "alice", ["bob"])
+        shared = [await create_conversation(client, ids, "alice", ["bob"]) for _ in range(ROOMS)]
+        foreign = [await create_conversation(client, ids, "alice", ["carol"]) for _ in range(ROOMS)]
+    
+    async with websockets.connect(WS_URL.format(BASE_PORT, token_for(ids["alice"]))) as alice, \
+            websockets.connect(WS_URL.format(BASE_PORT + 1, token_for(ids["bob"]))) as bob:
+        await asyncio.sleep(0.5)  # let the nodes LISTEN on the new room channels
+        
+        start = time.perf_counter()
+        await alice.send(json.dumps({"v": 1, "type": "typing", "conversation_id": conversation_id}))
+        typing = await receive_type(bob, "typing_indicator")
+        typing_ms = (time.perf_counter() - start) * 1000
+        
+        start = time.perf_counter()
+        await alice.send(json.dumps({
+            "v": 1, "id": "m1", "type": "send_message", "conversation_id": conversation_id, "content": "hello"
+        }))
+        message = await receive_type(bob, "new_message")
+        message_ms = (time.perf_counter() - start) * 1000
+        ack = await receive_type(alice, "ack")
+    
+    assert typing["data"]["user_id"] == ids["alice"]
+    assert message["data"]["content"] == "hello" and ack["ok"]
+    print(f"typing node-0 -> node-1: {typing_ms:.1f} ms")
+    print(f"message node-0 -> node-1: {message_ms:.1f} ms")
+    
+    metrics = backplane_metrics()
+    for m in metrics:
+        print(m)
+    assert metrics[1]["received"] >= 1, "node-1 got no backplane events"
+    assert all(m["received"] == 0 for m in metrics[2:]), "idle nodes received backplane events"
+    
+    await filter_ratio(ids, shared, foreign)
+    print("OK")
+
+
+async def filter_ratio(ids: dict, shared: list, foreign: list):
+    """Typing in ROOMS rooms node-1 hosts and ROOMS it doesn't; count what node-1 had to drop"""
+    async with websockets.connect(WS_URL.format(BASE_PORT, token_for(ids["alice"]))) as alice, \
+            websockets.connect(WS_URL.format(BASE_PORT + 1, token_for(ids["bob"]))) as bob:
+        await asyncio.sleep(1)
+        before = backplane_metrics()[1]
+        for conversation_id in shared + foreign:
+            await alice.send(json.dumps({"v": 1, "type": "typing", "conversation_id": conversation_id}))
+        for _ in shared:
+            await receive_type(bob, "typing_indicator")
+        await asyncio.sleep(1)  # let the foreign notifications arrive too
+        after = backplane_metrics()[1]
+    
+    received = after["received"] - before["received"]
+    filtered = after["filtered"] - before["filtered"]
+    shards = int(os.getenv("WS_BACKPLANE_SHARDS", "256"))
+    room_channels = after["channels"] - 1  # The rest is bob's user channel
+    print(f"node-1 listens on {room_channels} of {shards} room channels for {ROOMS} rooms")
+    print(f"node-1 dropped {filtered} of {len(foreign)} events for rooms it does not host "
+          f"({filtered / len(foreign):.0%}, expected about {room_channels / shards:.0%}); "
+          f"delivered {received} of {len(shared)}")
+    assert received >= len(shared)
+
+
+def main():
+    # One at a time: concurrent startup DDL (CREATE OR REPLACE FUNCTION) can fail
+    # with "tuple concurrently updated"
+    nodes = []
+    try:
+        for i in range(NODES):
+            nodes.append(start_node(i))
+            wait_ready(i)
+        asyncio.run(scenario())
+    finally:
+        for node in nodes:
+            node.terminate()
+        for node in nodes:
+            node.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,31 @@ from fastapi import FastAPI
 import json
 import asyncio
 import asyncpg
-from src.database.core import Base, engine
+import os
+from src.database.core import Base, engine, async_engine, AsyncSessionLocal, get_pool_status
 from src.auth.contoller import router as auth_router
 from src.users.controller import router as user_router
 from src.conversation.controller import router as conversation_router
 from src.message.controller import router as message_router
 from src.websocket.websocket_controller import router as websocket_router
-from src.websocket.websocket_manager import postgres_notifier
+from src.sync.controller import router as sync_router
+from src.media.controller import router as media_router
+from src.websocket.websocket_manager import postgres_notifier, backplane, manager
+from src.websocket.typing_state import typing_store
+from src.websocket.presence import presence
+from src.conversation.services import reconcile_unread_counts
+from src.sync.services import change_log_pruner, change_log_sequencer
+from src.media.services import media_collector
+from src.message.services import upload_sweeper
+from src.media.pipeline import media_pipeline
 from src.database.core import ASYNC_DATABASE_URL
+from src.auth.services import auth_cache, password_hasher
+from src.users.prefix_index import user_prefix_index, USER_CHANGES_CHANNEL
 
 Base.metadata.create_all(bind=engine)
 
+RECONCILE_UNREAD_ON_STARTUP = os.getenv("RECONCILE_UNREAD_ON_STARTUP", "false").lower() == "true"
+
 
 app = FastAPI()
 
@@ -21,143 +35,307 @@ def root():
     return {"message": "Welcome to fastapi messaging system"}
 
 
+@app.get("/metrics")
+def metrics():
+    return {
+        "db_pool": get_pool_status(),
+        "websocket": {**manager.stats(), **backplane.status()},
+        "media_pipeline": media_pipeline.status(),
+        "auth": {**auth_cache.stats(), "passwords": password_hasher.status()},
+        "user_search": user_prefix_index.status()
+    }
+
+
 app.include_router(auth_router)
 app.include_router(user_router)
 app.include_router(conversation_router)
 app.include_router(message_router)
 app.include_router(websocket_router)
+app.include_router(sync_router)
+app.include_router(media_router)
 
 
 @app.on_event("startup")
 async def startup():
+    await backplane.start()
     await postgres_notifier.connect()
+    presence.start(postgres_notifier.pool)
+    typing_store.start()
+    manager.start_reaper()
+    change_log_pruner.start()
+    media_collector.start()
+    upload_sweeper.start()
+    media_pipeline.start()
+    user_prefix_index.start()
     
     async with asyncpg.create_pool(ASYNC_DATABASE_URL) as pool:
         async with pool.acquire() as conn:
-            # New message trigger
+            # Columns and indexes added after the tables were first created
+            await conn.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_conversation_keyset
+                ON messages (conversation_id, created_at, id) WHERE is_deleted = false
+            """)
+            
+            unread_column_added = await conn.fetchval("""
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'conversation_participants' AND column_name = 'unread_count'
+                )
+            """)
+            await conn.execute("""
+                ALTER TABLE conversation_participants
+                ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0
+            """)
+            
+            await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS media JSONB")
+            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0")
+            await conn.execute("ALTER TABLE media_blobs ADD COLUMN IF NOT EXISTS media JSONB")
+            
+            # Unread counter maintenance, in the same transaction as the message write
             await conn.execute("""
-                CREATE OR REPLACE FUNCTION notify_new_message()
+                CREATE OR REPLACE FUNCTION maintain_unread_counts()
                 RETURNS TRIGGER AS $$
-                DECLARE
-                    sender_data JSON;
                 BEGIN
-                    SELECT row_to_json(u.*) INTO sender_data FROM users u WHERE u.id = NEW.sender_id;
-                    PERFORM pg_notify('new_message', json_build_object(
-                        'id', NEW.id, 'conversation_id', NEW.conversation_id,
-                        'sender_id', NEW.sender_id, 'content', NEW.content,
-                        'message_type', NEW.message_type, 'file_url', NEW.file_url,
-                        'file_name', NEW.file_name, 'created_at', NEW.created_at,
-                        'sender', sender_data
-                    )::text);
+                    IF TG_OP = 'INSERT' AND NEW.is_deleted = FALSE THEN
+                        UPDATE conversation_participants SET unread_count = unread_count + 1
+                        WHERE conversation_id = NEW.conversation_id AND user_id != NEW.sender_id
+                        AND last_read_at < NEW.created_at;
+                    ELSIF TG_OP = 'UPDATE' AND OLD.is_deleted = FALSE AND NEW.is_deleted = TRUE THEN
+                        UPDATE conversation_participants SET unread_count = GREATEST(unread_count - 1, 0)
+                        WHERE conversation_id = NEW.conversation_id AND user_id != NEW.sender_id
+                        AND last_read_at < NEW.created_at;
+                    END IF;
                     RETURN NEW;
                 END;
                 $$ LANGUAGE plpgsql;
                 
+                DROP TRIGGER IF EXISTS unread_count_trigger ON messages;
+                CREATE TRIGGER unread_count_trigger AFTER INSERT OR UPDATE OF is_deleted ON messages
+                FOR EACH ROW EXECUTE FUNCTION maintain_unread_counts();
+            """)
+            
+            # Every realtime event goes out on the single chat_events channel and only
+            # carries IDs; the listener hydrates messages and users in batches.
+            await conn.execute("""
                 DROP TRIGGER IF EXISTS new_message_trigger ON messages;
-                CREATE TRIGGER new_message_trigger AFTER INSERT ON messages
-                FOR EACH ROW WHEN (NEW.is_deleted = FALSE)
-                EXECUTE FUNCTION notify_new_message();
+                DROP TRIGGER IF EXISTS message_edited_trigger ON messages;
+                DROP TRIGGER IF EXISTS message_deleted_trigger ON messages;
+                DROP FUNCTION IF EXISTS notify_new_message();
+                DROP FUNCTION IF EXISTS notify_message_edited();
+                DROP FUNCTION IF EXISTS notify_message_deleted();
             """)
             
-            # Message edited trigger
+            # Every event is appended to change_log (for /sync after a reconnect) with a
+            # negative provisional seq, and writers commit without waiting on each other
+            # (no lock, and no NOTIFY, which serialises commits too). The sequencers
+            # (ChangeLogSequencer, one per node) then number committed events and
+            # announce them; only they take the change_log lock, so seqs still become
+            # visible in order and a client resuming after any seq it has seen misses
+            # nothing.
             await conn.execute("""
-                CREATE OR REPLACE FUNCTION notify_message_edited()
-                RETURNS TRIGGER AS $$
+                CREATE SEQUENCE IF NOT EXISTS change_log_pending_seq;
+                
+                DROP TRIGGER IF EXISTS change_log_publish_trigger ON change_log;
+                DROP FUNCTION IF EXISTS publish_chat_event();
+                
+                CREATE OR REPLACE FUNCTION emit_chat_event(
+                    p_conversation_id TEXT, p_type TEXT, p_message_id TEXT, p_user_id TEXT, p_data TEXT
+                ) RETURNS BIGINT AS $$
+                DECLARE
+                    event_seq BIGINT;
                 BEGIN
-                    IF OLD.content != NEW.content AND NEW.is_deleted = FALSE THEN
-                        PERFORM pg_notify('message_edited', json_build_object(
-                            'id', NEW.id, 'conversation_id', NEW.conversation_id,
-                            'content', NEW.content, 'is_edited', NEW.is_edited,
-                            'edited_at', NEW.edited_at
-                        )::text);
-                    END IF;
-                    RETURN NEW;
+                    INSERT INTO change_log (seq, conversation_id, type, message_id, user_id, data, created_at)
+                    VALUES (
+                        -nextval('change_log_pending_seq'), p_conversation_id, p_type, p_message_id, p_user_id,
+                        COALESCE(p_data::jsonb, '{}'::jsonb), now() AT TIME ZONE 'utc'
+                    )
+                    RETURNING seq INTO event_seq;
+                    RETURN event_seq;
                 END;
                 $$ LANGUAGE plpgsql;
                 
-                DROP TRIGGER IF EXISTS message_edited_trigger ON messages;
-                CREATE TRIGGER message_edited_trigger AFTER UPDATE ON messages
-                FOR EACH ROW EXECUTE FUNCTION notify_message_edited();
+                CREATE OR REPLACE FUNCTION sequence_chat_events(p_limit INTEGER)
+                RETURNS INTEGER AS $$
+                DECLARE
+                    pending BIGINT;
+                    event RECORD;
+                    sequenced INTEGER := 0;
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM change_log WHERE seq < 0) THEN
+                        RETURN 0;
+                    END IF;
+                    -- Held until this batch is visible, so the next sequencer numbers after it
+                    PERFORM pg_advisory_xact_lock(hashtext('change_log'));
+                    FOR pending IN
+                        SELECT seq FROM change_log WHERE seq < 0 ORDER BY seq DESC LIMIT p_limit
+                    LOOP
+                        UPDATE change_log SET seq = nextval(pg_get_serial_sequence('change_log', 'seq'))
+                        WHERE seq = pending
+                        RETURNING * INTO event;
+                        
+                        PERFORM pg_notify('chat_events', (jsonb_build_object(
+                            'seq', event.seq, 'type', event.type, 'conversation_id', event.conversation_id,
+                            'message_id', event.message_id, 'user_id', event.user_id
+                        ) || event.data)::text);
+                        sequenced := sequenced + 1;
+                    END LOOP;
+                    RETURN sequenced;
+                END;
+                $$ LANGUAGE plpgsql;
             """)
             
-            # Message deleted trigger
+            # Message created/edited/deleted trigger
             await conn.execute("""
-                CREATE OR REPLACE FUNCTION notify_message_deleted()
+                CREATE OR REPLACE FUNCTION notify_message_change()
                 RETURNS TRIGGER AS $$
+                DECLARE event_type TEXT;
                 BEGIN
-                    IF OLD.is_deleted = FALSE AND NEW.is_deleted = TRUE THEN
-                        PERFORM pg_notify('message_deleted', json_build_object(
-                            'id', NEW.id, 'conversation_id', NEW.conversation_id,
-                            'deleted_at', NEW.deleted_at
-                        )::text);
+                    IF TG_OP = 'INSERT' THEN
+                        IF NEW.is_deleted = FALSE THEN
+                            event_type := 'new_message';
+                        END IF;
+                    ELSIF OLD.is_deleted = FALSE AND NEW.is_deleted = TRUE THEN
+                        event_type := 'message_deleted';
+                    ELSIF OLD.content != NEW.content AND NEW.is_deleted = FALSE THEN
+                        event_type := 'message_edited';
+                    END IF;
+                    
+                    IF event_type IS NOT NULL THEN
+                        PERFORM emit_chat_event(NEW.conversation_id, event_type, NEW.id, NEW.sender_id, NULL);
                     END IF;
                     RETURN NEW;
                 END;
                 $$ LANGUAGE plpgsql;
                 
-                DROP TRIGGER IF EXISTS message_deleted_trigger ON messages;
-                CREATE TRIGGER message_deleted_trigger AFTER UPDATE ON messages
-                FOR EACH ROW EXECUTE FUNCTION notify_message_deleted();
+                DROP TRIGGER IF EXISTS message_change_trigger ON messages;
+                CREATE TRIGGER message_change_trigger AFTER INSERT OR UPDATE OF content, is_deleted ON messages
+                FOR EACH ROW EXECUTE FUNCTION notify_message_change();
+            """)
+            
+            # Typing indicators are ephemeral and fanned out from memory by the
+            # typing store, so the table trigger is gone
+            await conn.execute("""
+                DROP TRIGGER IF EXISTS typing_trigger ON typing_indicators;
+                DROP FUNCTION IF EXISTS notify_typing();
+            """)
+            
+            # Read receipts are bulk inserted and announced once per read-up-to call
+            # by the service, so there is no per-row trigger anymore
+            await conn.execute("""
+                DROP TRIGGER IF EXISTS read_receipt_trigger ON message_read_receipts;
+                DROP FUNCTION IF EXISTS notify_message_read();
             """)
             
-            # Typing indicator trigger
+            # Media blob reference counts, from message attachments and avatars. Only
+            # content-addressed URLs count; deleted messages drop their reference.
+            await conn.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_file_url
+                ON messages (file_url) WHERE file_url IS NOT NULL
+            """)
+            await conn.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_avatar_url
+                ON users (avatar_url) WHERE avatar_url IS NOT NULL
+            """)
             await conn.execute("""
-                CREATE OR REPLACE FUNCTION notify_typing()
+                CREATE OR REPLACE FUNCTION media_ref(url TEXT) RETURNS TEXT AS $$
+                    SELECT CASE WHEN url LIKE '/media/%' THEN substring(url FROM 8) END
+                $$ LANGUAGE sql IMMUTABLE;
+                
+                CREATE OR REPLACE FUNCTION maintain_media_refs()
                 RETURNS TRIGGER AS $$
-                DECLARE user_data JSON;
+                DECLARE
+                    old_ref TEXT;
+                    new_ref TEXT;
                 BEGIN
-                    SELECT row_to_json(u.*) INTO user_data FROM users u WHERE u.id = NEW.user_id;
-                    PERFORM pg_notify('typing_indicator', json_build_object(
-                        'conversation_id', NEW.conversation_id,
-                        'user_id', NEW.user_id, 'user', user_data, 'is_typing', TRUE
-                    )::text);
+                    IF TG_TABLE_NAME = 'messages' THEN
+                        IF TG_OP = 'UPDATE' AND OLD.is_deleted = FALSE THEN
+                            old_ref := media_ref(OLD.file_url);
+                        END IF;
+                        IF NEW.is_deleted = FALSE THEN
+                            new_ref := media_ref(NEW.file_url);
+                        END IF;
+                    ELSE
+                        IF TG_OP = 'UPDATE' THEN
+                            old_ref := media_ref(OLD.avatar_url);
+                        END IF;
+                        new_ref := media_ref(NEW.avatar_url);
+                    END IF;
+                    
+                    IF old_ref IS DISTINCT FROM new_ref THEN
+                        UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old_ref;
+                        UPDATE media_blobs SET ref_count = ref_count + 1, last_used_at = now() AT TIME ZONE 'utc'
+                        WHERE sha256 = new_ref;
+                    END IF;
                     RETURN NEW;
                 END;
                 $$ LANGUAGE plpgsql;
                 
-                DROP TRIGGER IF EXISTS typing_trigger ON typing_indicators;
-                CREATE TRIGGER typing_trigger AFTER INSERT ON typing_indicators
-                FOR EACH ROW EXECUTE FUNCTION notify_typing();
+                DROP TRIGGER IF EXISTS message_media_refs_trigger ON messages;
+                CREATE TRIGGER message_media_refs_trigger AFTER INSERT OR UPDATE OF file_url, is_deleted ON messages
+                FOR EACH ROW EXECUTE FUNCTION maintain_media_refs();
+                
+                DROP TRIGGER IF EXISTS user_media_refs_trigger ON users;
+                CREATE TRIGGER user_media_refs_trigger AFTER INSERT OR UPDATE OF avatar_url ON users
+                FOR EACH ROW EXECUTE FUNCTION maintain_media_refs();
             """)
             
-            # Read receipt trigger
+            # User search: byte-ordered expression indexes serve exact and prefix
+            # matches already in result order, trigram indexes serve substring matches
+            await conn.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_search
+                ON users ((lower(username) COLLATE "C"), id)
+            """)
             await conn.execute("""
-                CREATE OR REPLACE FUNCTION notify_message_read()
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_display_name_search
+                ON users ((lower(display_name) COLLATE "C"), id)
+            """)
+            try:
+                await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            except asyncpg.PostgresError as e:
+                print(f"pg_trgm unavailable, substring user search will scan users (USER_SEARCH_SUBSTRING=false disables it): {e}")
+            else:
+                await conn.execute("""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_trgm
+                    ON users USING gin (lower(username) gin_trgm_ops)
+                """)
+                await conn.execute("""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_display_name_trgm
+                    ON users USING gin (lower(display_name) gin_trgm_ops)
+                """)
+            
+            # Keeps the in-process user prefix index of every node current
+            await conn.execute(f"""
+                CREATE OR REPLACE FUNCTION notify_user_change()
                 RETURNS TRIGGER AS $$
                 BEGIN
-                    PERFORM pg_notify('message_read', json_build_object(
-                        'message_id', NEW.message_id, 'user_id', NEW.user_id,
-                        'read_at', NEW.read_at,
-                        'conversation_id', (SELECT conversation_id FROM messages WHERE id = NEW.message_id)
-                    )::text);
+                    IF TG_OP = 'INSERT' OR NEW.username IS DISTINCT FROM OLD.username
+                       OR NEW.display_name IS DISTINCT FROM OLD.display_name
+                       OR NEW.is_active IS DISTINCT FROM OLD.is_active
+                       OR NEW.token_version IS DISTINCT FROM OLD.token_version THEN
+                        PERFORM pg_notify('{USER_CHANGES_CHANNEL}', NEW.id);
+                    END IF;
                     RETURN NEW;
                 END;
                 $$ LANGUAGE plpgsql;
                 
-                DROP TRIGGER IF EXISTS read_receipt_trigger ON message_read_receipts;
-                CREATE TRIGGER read_receipt_trigger AFTER INSERT ON message_read_receipts
-                FOR EACH ROW EXECUTE FUNCTION notify_message_read();
+                DROP TRIGGER IF EXISTS user_change_trigger ON users;
+                CREATE TRIGGER user_change_trigger
+                AFTER INSERT OR UPDATE OF username, display_name, is_active, token_version ON users
+                FOR EACH ROW EXECUTE FUNCTION notify_user_change();
             """)
             
             # Participant added/removed triggers
             await conn.execute("""
                 CREATE OR REPLACE FUNCTION notify_participant_change()
                 RETURNS TRIGGER AS $$
-                DECLARE user_data JSON;
                 BEGIN
-                    SELECT row_to_json(u.*) INTO user_data FROM users u WHERE u.id = NEW.user_id;
-                    
-                    IF TG_OP = 'INSERT' THEN
-                        PERFORM pg_notify('participant_added', json_build_object(
-                            'conversation_id', NEW.conversation_id,
-                            'user_id', NEW.user_id, 'user', user_data,
-                            'role', NEW.role
-                        )::text);
+                    IF TG_OP = 'INSERT' OR (OLD.is_active = FALSE AND NEW.is_active = TRUE) THEN
+                        PERFORM emit_chat_event(
+                            NEW.conversation_id, 'participant_added', NULL, NEW.user_id,
+                            json_build_object('role', NEW.role)::text
+                        );
                     ELSIF TG_OP = 'UPDATE' AND OLD.is_active = TRUE AND NEW.is_active = FALSE THEN
-                        PERFORM pg_notify('participant_removed', json_build_object(
-                            'conversation_id', NEW.conversation_id,
-                            'user_id', NEW.user_id
-                        )::text);
+                        PERFORM emit_chat_event(NEW.conversation_id, 'participant_removed', NULL, NEW.user_id, NULL);
                     END IF;
                     RETURN NEW;
                 END;
@@ -165,12 +343,29 @@ async def startup():
                 
                 DROP TRIGGER IF EXISTS participant_change_trigger ON conversation_participants;
                 CREATE TRIGGER participant_change_trigger
-                AFTER INSERT OR UPDATE ON conversation_participants
+                AFTER INSERT OR UPDATE OF is_active ON conversation_participants
                 FOR EACH ROW EXECUTE FUNCTION notify_participant_change();
             """)
     
     print("Database triggers created")
+    await change_log_sequencer.start()
+    
+    if unread_column_added or RECONCILE_UNREAD_ON_STARTUP:
+        async with AsyncSessionLocal() as db:
+            await reconcile_unread_counts(db)
+        print("Unread counters reconciled")
 
 @app.on_event("shutdown")
 async def shutdown():
-    await postgres_notifier.close()
\ No newline at end of file
+    await manager.stop_reaper()
+    await change_log_sequencer.stop()
+    await change_log_pruner.stop()
+    await media_collector.stop()
+    await upload_sweeper.stop()
+    await media_pipeline.stop()
+    await user_prefix_index.stop()
+    await typing_store.stop()
+    await presence.stop()
+    await postgres_notifier.close()
+    await backplane.stop()
+    await async_engine.dispose()
\ No newline at end of file
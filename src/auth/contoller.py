@@ -1,10 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 from src.auth.models import UserCreate, Token
-from src.auth.services import get_password_hash, create_access_token, verify_password
+from src.auth.services import password_hasher, create_access_token, get_current_user, revoke_tokens
 from src.entities.users import User
-from src.database.core import get_db
+from src.database.core import get_async_db
 
 router = APIRouter(
     tags=["Authentication"],
@@ -13,25 +14,25 @@ router = APIRouter(
 
 
 @router.post("/register",)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user"""
     # Check if user exists
-    if db.query(User).filter(User.username == user.username).first():
+    if await db.scalar(select(User).where(User.username == user.username)):
         raise HTTPException(status_code=400, detail="Username already taken")
-    if db.query(User).filter(User.email == user.email).first():
+    if await db.scalar(select(User).where(User.email == user.email)):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create user
     db_user = User(
         username=user.username,
         email=user.email,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await password_hasher.hash(user.password),
         display_name=user.display_name or user.username
     )
 
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     # Create token
     # access_token = create_access_token(data={"sub": db_user.id})
@@ -42,19 +43,33 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
 
 
 @router.post("/login", response_model=Token)
-def login(username: str, password: str, db: Session = Depends(get_db)):
+async def login(username: str, password: str, db: AsyncSession = Depends(get_async_db)):
     """Login user"""
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+    user = await db.scalar(select(User).where(User.username == username))
+    if not user or not await password_hasher.verify(password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade hashes made with a different BCRYPT_ROUNDS while we have the password
+    if password_hasher.needs_rehash(user.hashed_password):
+        try:
+            user.hashed_password = await password_hasher.hash(password)
+        except HTTPException:
+            pass  # Shedding load; a later login will rehash
+    
     # Update online status
     user.is_online = True
     user.last_seen = datetime.utcnow()
-    db.commit()
+    await db.commit()
     
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(data={"sub": user.id, "ver": user.token_version})
     return {
         "access_token": access_token,
         "token_type": "bearer"
-    }
\ No newline at end of file
+    }
+
+
+@router.post("/logout")
+async def logout(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Log out everywhere: every token issued so far stops working"""
+    await revoke_tokens(current_user.id, db)
+    return {"message": "Logged out"}
@@ -1,13 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import Depends, HTTPException, status, UploadFile
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from typing import Optional, Tuple
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from src.database.core import get_db
+from src.database.core import get_async_db
 from src.entities.users import User
+from src.websocket.events import TTLCache
+import asyncio
 import bcrypt
+import hashlib
 import os
-import shutil
+import time
 import uuid
 from dotenv import load_dotenv
 
@@ -19,15 +26,23 @@ security = HTTPBearer()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")  # 7 days
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", str(7 * 24 * 60)))  # 7 days
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# How long a cached user may be served; also bounds how late other nodes notice a logout
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt runs on its own threads so a login storm cannot starve the shared threadpool
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Password operations running or queued beyond this are refused with a 503
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "64"))
 UPLOAD_DIR = "uploads"
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(100 * 1024 * 1024)))
+UPLOAD_COPY_BUFFER = 1024 * 1024
 
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(f"{UPLOAD_DIR}/images", exist_ok=True)
-os.makedirs(f"{UPLOAD_DIR}/videos", exist_ok=True)
-os.makedirs(f"{UPLOAD_DIR}/files", exist_ok=True)
-os.makedirs(f"{UPLOAD_DIR}/avatars", exist_ok=True)
+os.makedirs(f"{UPLOAD_DIR}/media", exist_ok=True)
+os.makedirs(f"{UPLOAD_DIR}/partial", exist_ok=True)
 
 def get_password_hash(password: str) -> str:
     """Hash a password using bcrypt"""
@@ -39,7 +54,7 @@ def get_password_hash(password: str) -> str:
         password_bytes = password_bytes[:72]
     
     # Generate salt and hash password
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password_bytes, salt)
     
     # Return as string
@@ -59,47 +74,201 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     # Check password
     return bcrypt.checkpw(password_bytes, hashed_bytes)
 
+def password_rounds(hashed_password: str) -> int:
+    """Cost factor of a bcrypt hash ($2b$<rounds>$...)"""
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, bounded thread pool.
+    
+    bcrypt releases the GIL, so PASSWORD_WORKERS threads hash in parallel
+    without touching the threadpool that serves sync endpoints and file I/O.
+    When PASSWORD_QUEUE_LIMIT operations are already running or waiting, new
+    ones are shed with a 503 instead of queueing without bound.
+    """
+    
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+        self.in_flight = 0
+        self.completed = 0
+        self.shed = 0
+    
+    async def run(self, func, *args):
+        if self.in_flight >= PASSWORD_QUEUE_LIMIT:
+            self.shed += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"}
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> str:
+        return await self.run(get_password_hash, password)
+    
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self.run(verify_password, password, hashed_password)
+    
+    def needs_rehash(self, hashed_password: str) -> bool:
+        return password_rounds(hashed_password) != BCRYPT_ROUNDS
+    
+    def status(self) -> dict:
+        return {
+            "workers": PASSWORD_WORKERS, "rounds": BCRYPT_ROUNDS, "queue_limit": PASSWORD_QUEUE_LIMIT,
+            "in_flight": self.in_flight, "completed": self.completed, "shed": self.shed
+        }
+
+
+password_hasher = PasswordHasher()
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
+    
     return encoded_jwt
 
-def decode_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
-    except JWTError:
-        return None
+USER_COLUMNS = [column.key for column in User.__table__.columns]
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+class AuthCache:
+    """Decoded tokens and user snapshots shared by requests.
+    
+    A token is decoded once and its (user_id, token version, expiry) kept; users
+    are kept as plain column snapshots for AUTH_CACHE_TTL seconds. A token is
+    only accepted while its version matches the user's, so bumping
+    users.token_version (logout, account deletion) revokes every token of the
+    user. Changes to a user must call invalidate() so this node reloads it;
+    token version, name and activation changes are also announced on the
+    user_changes channel, which invalidates the snapshot on every node and
+    closes the user's revoked sockets.
+    """
+    
+    def __init__(self):
+        self.tokens = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+        self.users = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+        self.token_hits = 0
+        self.token_misses = 0
+        self.user_hits = 0
+        self.user_misses = 0
+        self.requests = 0
+        self.seconds = 0.0
+    
+    def claims(self, token: str) -> Optional[Tuple[str, int]]:
+        """(user_id, token_version) of a valid token, or None"""
+        cached = self.tokens.get(token)
+        if cached is None:
+            self.token_misses += 1
+            try:
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            except JWTError:
+                return None
+            if not payload.get("sub"):
+                return None
+            cached = (payload["sub"], payload.get("ver", 0), payload.get("exp"))
+            self.tokens.set(token, cached)
+        else:
+            self.token_hits += 1
+            if cached[2] is not None and cached[2] <= time.time():
+                self.tokens.pop(token)
+                return None
+        return cached[0], cached[1]
+    
+    async def load_user(self, user_id: str, db: AsyncSession) -> Optional[User]:
+        """The user attached to `db`, from the snapshot when there is one"""
+        snapshot = self.users.get(user_id)
+        if snapshot is None:
+            self.user_misses += 1
+            user = await db.scalar(select(User).where(User.id == user_id))
+            if user:
+                self.users.set(user_id, {key: getattr(user, key) for key in USER_COLUMNS})
+            return user
+        
+        self.user_hits += 1
+        # Attached as if just loaded, so handlers can still modify and commit it
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+    
+    def invalidate(self, user_id: str):
+        self.users.pop(user_id)
+    
+    def stats(self) -> dict:
+        return {
+            "token_hits": self.token_hits, "token_misses": self.token_misses,
+            "user_hits": self.user_hits, "user_misses": self.user_misses,
+            "cached_tokens": len(self.tokens), "cached_users": len(self.users),
+            "avg_auth_ms": round(self.seconds * 1000 / self.requests, 3) if self.requests else 0.0
+        }
 
-    token = credentials.credentials
-    user_id = decode_token(token)
 
-    if not user_id:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials"
-        )
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    return user
+auth_cache = AuthCache()
 
 
-def save_upload_file(upload_file: UploadFile, subfolder: str) -> tuple:
-    """Save uploaded file and return (file_path, file_size)"""
-    file_extension = upload_file.filename.split(".")[-1]
-    file_name = f"{uuid.uuid4()}.{file_extension}"
-    file_path = f"{UPLOAD_DIR}/{subfolder}/{file_name}"
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)):
+
+    started = time.perf_counter()
+    try:
+        claims = auth_cache.claims(credentials.credentials)
+        if not claims:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication credentials"
+            )
+        user_id, token_version = claims
+        user = await auth_cache.load_user(user_id, db)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        if user.token_version != token_version:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+        
+        return user
+    finally:
+        auth_cache.requests += 1
+        auth_cache.seconds += time.perf_counter() - started
+
+
+async def revoke_tokens(user_id: str, db: AsyncSession):
+    """Invalidate every token issued to the user so far, committing `db`"""
+    await db.execute(update(User).where(User.id == user_id).values(token_version=User.token_version + 1))
+    await db.commit()
+    auth_cache.invalidate(user_id)
+
+
+def save_upload_file(upload_file: UploadFile) -> tuple:
+    """Stream an upload to a temporary file and return (temp_path, file_size, sha256).
+    
+    Blocking, run it in the threadpool. Files larger than MAX_UPLOAD_SIZE are
+    rejected with a 413 as soon as the limit is crossed. The caller hands the
+    file to the media store and removes it afterwards.
+    """
+    temp_path = f"{UPLOAD_DIR}/partial/{uuid.uuid4()}.tmp"
+    hasher = hashlib.sha256()
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(upload_file.file, buffer)
+    file_size = 0
+    with open(temp_path, "wb") as buffer:
+        while True:
+            chunk = upload_file.file.read(UPLOAD_COPY_BUFFER)
+            if not chunk:
+                break
+            file_size += len(chunk)
+            if file_size > MAX_UPLOAD_SIZE:
+                break
+            hasher.update(chunk)
+            buffer.write(chunk)
     
-    file_size = os.path.getsize(file_path)
-    return file_path, file_size
\ No newline at end of file
+    if file_size > MAX_UPLOAD_SIZE:
+        os.remove(temp_path)
+        raise HTTPException(status_code=413, detail=f"File larger than {MAX_UPLOAD_SIZE} bytes")
+    return temp_path, file_size, hasher.hexdigest()
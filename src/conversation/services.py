@@ -1,41 +1,51 @@
 from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update, func, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import List, Optional
 from src.conversation.models import ConversationCreate, ConversationResponse, ConversationUpdate, AddParticipantsRequest, TypingEvent, ParticipantResponse
 from src.auth.services import get_current_user
 from src.entities.conversation import Conversation
 from src.entities.conversation_participant import ConversationParticipant
 from src.entities.users import User
+from src.users.models import UserResponse
 from src.entities.message import Message, MessageType
-from src.entities.typing_indicator import TypingIndicator
-from src.database.core import get_db
+from src.websocket.typing_state import typing_store
+from src.database.core import get_async_db
 from src.entities.conversation_participant import ParticipantRole
 from datetime import datetime
 
-def create_conversations(
+async def create_conversations(
     conv: ConversationCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create conversation"""
-    participants = db.query(User).filter(User.id.in_(conv.participant_ids), User.is_active == True).all()
+    participants = (await db.execute(
+        select(User).where(User.id.in_(conv.participant_ids), User.is_active == True)
+    )).scalars().all()
     if len(participants) != len(conv.participant_ids):
         raise HTTPException(status_code=400, detail="Some users not found")
     
     # Check if 1-on-1 exists
     if not conv.is_group and len(conv.participant_ids) == 1:
         other_user_id = conv.participant_ids[0]
-        existing = db.query(Conversation).join(ConversationParticipant
-                                               ).filter(Conversation.is_group == False).filter(ConversationParticipant.user_id.in_([current_user.id, other_user_id]))\
-            .filter(ConversationParticipant.is_active == True).group_by(Conversation.id).having(db.func.count(ConversationParticipant.id) == 2).first()
+        existing = await db.scalar(
+            select(Conversation).join(ConversationParticipant)
+            .where(Conversation.is_group == False)
+            .where(ConversationParticipant.user_id.in_([current_user.id, other_user_id]))
+            .where(ConversationParticipant.is_active == True)
+            .group_by(Conversation.id).having(func.count(ConversationParticipant.id) == 2)
+        )
         
         if existing:
-            return get_conversation_response(existing, current_user.id, db)
+            return await get_conversation_response(existing, current_user.id, db)
     
     conversation = Conversation(
         name=conv.name, is_group=conv.is_group, created_by=current_user.id
     )
     db.add(conversation)
-    db.flush()
+    await db.flush()
     
     # Add creator as admin
     creator_participant = ConversationParticipant(
@@ -55,67 +65,70 @@ def create_conversations(
             )
             db.add(participant)
     
-    db.commit()
-    db.refresh(conversation)
-    return get_conversation_response(conversation, current_user.id, db)
+    await db.commit()
+    await db.refresh(conversation)
+    return await get_conversation_response(conversation, current_user.id, db)
 
 
-def get_all_conversations(
+async def get_all_conversations(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all user conversations"""
-    conversations = db.query(Conversation)\
-        .join(ConversationParticipant)\
-        .filter(ConversationParticipant.user_id == current_user.id)\
-        .filter(ConversationParticipant.is_active == True)\
-        .order_by(Conversation.updated_at.desc())\
-        .all()
-    
-    return [get_conversation_response(conv, current_user.id, db) for conv in conversations]
+    conversations = (await db.execute(
+        select(Conversation)
+        .join(ConversationParticipant)
+        .where(ConversationParticipant.user_id == current_user.id)
+        .where(ConversationParticipant.is_active == True)
+        .order_by(Conversation.updated_at.desc())
+    )).scalars().all()
+    
+    return await get_conversation_responses(conversations, current_user.id, db)
 
 
-def get_conversation(
+async def get_conversation(
     conversation_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get specific conversation"""
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    participant = db.query(ConversationParticipant)\
-        .filter(
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not participant:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    return get_conversation_response(conversation, current_user.id, db)
+    return await get_conversation_response(conversation, current_user.id, db)
 
 
 
-def update_conversations(
+async def update_conversations(
     conversation_id: str,
     update: ConversationUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update conversation (admin only)"""
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
     if not conversation:
         raise HTTPException(status_code=404, detail="Not found")
     
-    participant = db.query(ConversationParticipant)\
-        .filter(
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not participant or participant.role != ParticipantRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin only")
@@ -123,44 +136,46 @@ def update_conversations(
     if update.name:
         conversation.name = update.name
     
-    db.commit()
-    db.refresh(conversation)
-    return get_conversation_response(conversation, current_user.id, db)
+    await db.commit()
+    await db.refresh(conversation)
+    return await get_conversation_response(conversation, current_user.id, db)
 
 
 
-def add_participants(
+async def add_participants(
     conversation_id: str,
     request: AddParticipantsRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Add participants to group (admin only)"""
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
     if not conversation or not conversation.is_group:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    my_participant = db.query(ConversationParticipant)\
-        .filter(
+    my_participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not my_participant or my_participant.role != ParticipantRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin only")
     
     added_users = []
     for user_id in request.user_ids:
-        user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
+        user = await db.scalar(select(User).where(User.id == user_id, User.is_active == True))
         if not user:
             continue
         
-        existing = db.query(ConversationParticipant)\
-            .filter(
+        existing = await db.scalar(
+            select(ConversationParticipant).where(
                 ConversationParticipant.conversation_id == conversation_id,
                 ConversationParticipant.user_id == user_id
-            ).first()
+            )
+        )
         
         if existing:
             if not existing.is_active:
@@ -186,27 +201,28 @@ def add_participants(
         )
         db.add(system_msg)
     
-    db.commit()
+    await db.commit()
     return {"message": f"Added {len(added_users)} participants", "added_user_ids": added_users}
 
 
-def remove_participants(
+async def remove_participants(
     conversation_id: str,
     user_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Remove participant from group (admin only or self)"""
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
     if not conversation or not conversation.is_group:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    my_participant = db.query(ConversationParticipant)\
-        .filter(
+    my_participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not my_participant:
         raise HTTPException(status_code=403, detail="Not a participant")
@@ -215,12 +231,13 @@ def remove_participants(
     if user_id != current_user.id and my_participant.role != ParticipantRole.ADMIN:
         raise HTTPException(status_code=403, detail="Admin only")
     
-    target_participant = db.query(ConversationParticipant)\
-        .filter(
+    target_participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == user_id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not target_participant:
         raise HTTPException(status_code=404, detail="Participant not found")
@@ -230,7 +247,7 @@ def remove_participants(
     target_participant.left_at = datetime.utcnow()
     
     # System message
-    target_user = db.query(User).filter(User.id == user_id).first()
+    target_user = await db.scalar(select(User).where(User.id == user_id))
     action = "left" if user_id == current_user.id else "removed"
     system_msg = Message(
         conversation_id=conversation_id,
@@ -240,22 +257,23 @@ def remove_participants(
     )
     db.add(system_msg)
     
-    db.commit()
+    await db.commit()
     return {"message": "Participant removed"}
 
 
-def leave_conversations(
+async def leave_conversations(
     conversation_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Leave a conversation"""
-    participant = db.query(ConversationParticipant)\
-        .filter(
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not participant:
         raise HTTPException(status_code=404, detail="Not a participant")
@@ -263,7 +281,7 @@ def leave_conversations(
     participant.is_active = False
     participant.left_at = datetime.utcnow()
     
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
     if conversation.is_group:
         system_msg = Message(
             conversation_id=conversation_id,
@@ -273,76 +291,130 @@ def leave_conversations(
         )
         db.add(system_msg)
     
-    db.commit()
+    await db.commit()
     return {"message": "Left conversation"}
 
-def get_conversation_response(conversation: Conversation, user_id: str, db: Session):
+async def get_conversation_response(conversation: Conversation, user_id: str, db: AsyncSession):
     """Build conversation response with metadata"""
-    last_message = db.query(Message)\
-        .filter(Message.conversation_id == conversation.id, Message.is_deleted == False)\
-        .order_by(Message.created_at.desc())\
-        .first()
-    
-    participant = db.query(ConversationParticipant)\
-        .filter(
-            ConversationParticipant.conversation_id == conversation.id,
-            ConversationParticipant.user_id == user_id
-        ).first()
-    
-    unread_count = 0
-    my_role = None
-    if participant:
-        my_role = participant.role.value
-        unread_count = db.query(Message)\
-            .filter(
-                Message.conversation_id == conversation.id,
-                Message.created_at > participant.last_read_at,
-                Message.sender_id != user_id,
-                Message.is_deleted == False
-            ).count()
-    
-    participant_responses = []
-    for p in conversation.participants:
-        if p.is_active:
-            participant_responses.append(ParticipantResponse(
-                user=p.user,
-                role=p.role.value,
-                joined_at=p.joined_at
+    return (await get_conversation_responses([conversation], user_id, db))[0]
+
+
+async def get_conversation_responses(conversations: List[Conversation], user_id: str, db: AsyncSession):
+    """Build responses for many conversations at once.
+
+    Runs a fixed three queries however many conversations are passed: my
+    participant rows (which carry the materialized unread counters), the last
+    message of each conversation (lateral join on the keyset index), and active
+    participants with their users.
+    """
+    if not conversations:
+        return []
+    conversation_ids = [c.id for c in conversations]
+    
+    my_participants = {
+        p.conversation_id: p for p in (await db.execute(
+            select(ConversationParticipant).where(
+                ConversationParticipant.conversation_id.in_(conversation_ids),
+                ConversationParticipant.user_id == user_id
+            )
+        )).scalars()
+    }
+    
+    latest = select(Message.id)\
+        .where(Message.conversation_id == Conversation.id, Message.is_deleted == False)\
+        .order_by(Message.created_at.desc(), Message.id.desc())\
+        .limit(1)\
+        .lateral()
+    last_messages = {
+        m.conversation_id: m for m in (await db.execute(
+            select(Message)
+            .options(joinedload(Message.sender))
+            .where(Message.id.in_(
+                select(latest.c.id).select_from(Conversation).join(latest, true())
+                .where(Conversation.id.in_(conversation_ids))
             ))
-    
-    return ConversationResponse(
-        id=conversation.id,
-        name=conversation.name,
-        is_group=conversation.is_group,
-        avatar_url=conversation.avatar_url,
-        created_at=conversation.created_at,
-        updated_at=conversation.updated_at,
-        participants=participant_responses,
-        last_message=last_message,
-        unread_count=unread_count,
-        my_role=my_role
-    )
+        )).scalars()
+    }
+    
+    participants_by_conversation = {}
+    for p in (await db.execute(
+        select(ConversationParticipant)
+        .options(joinedload(ConversationParticipant.user))
+        .where(
+            ConversationParticipant.conversation_id.in_(conversation_ids),
+            ConversationParticipant.is_active == True
+        )
+    )).scalars():
+        participants_by_conversation.setdefault(p.conversation_id, []).append(ParticipantResponse(
+            user=p.user,
+            role=p.role.value,
+            joined_at=p.joined_at
+        ))
+    
+    responses = []
+    for conversation in conversations:
+        participant = my_participants.get(conversation.id)
+        responses.append(ConversationResponse(
+            id=conversation.id,
+            name=conversation.name,
+            is_group=conversation.is_group,
+            avatar_url=conversation.avatar_url,
+            created_at=conversation.created_at,
+            updated_at=conversation.updated_at,
+            participants=participants_by_conversation.get(conversation.id, []),
+            last_message=last_messages.get(conversation.id),
+            unread_count=participant.unread_count if participant else 0,
+            my_role=participant.role.value if participant else None
+        ))
+    
+    return responses
 
 
 
-def send_typing_indicators(
+async def reconcile_unread_counts(db: AsyncSession, conversation_id: Optional[str] = None):
+    """Rebuild the materialized unread counters from messages.
+
+    The counters are kept up to date by the unread_count_trigger on messages;
+    this recomputes them from scratch, for one conversation or all of them.
+    """
+    unread = select(func.count(Message.id))\
+        .where(
+            Message.conversation_id == ConversationParticipant.conversation_id,
+            Message.created_at > ConversationParticipant.last_read_at,
+            Message.sender_id != ConversationParticipant.user_id,
+            Message.is_deleted == False
+        )\
+        .scalar_subquery()
+    stmt = update(ConversationParticipant).values(unread_count=unread)
+    if conversation_id:
+        stmt = stmt.where(ConversationParticipant.conversation_id == conversation_id)
+    await db.execute(stmt)
+    await db.commit()
+
+
+async def send_typing_indicators(
     conversation_id: str,
     event: TypingEvent,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Send typing indicator"""
-    if event.is_typing:
-        typing = TypingIndicator(conversation_id=conversation_id, user_id=current_user.id)
-        db.add(typing)
-        db.commit()
-    else:
-        db.query(TypingIndicator)\
-            .filter(
-                TypingIndicator.conversation_id == conversation_id,
-                TypingIndicator.user_id == current_user.id
-            ).delete()
-        db.commit()
+    """Send typing indicator.
+    
+    Typing state lives in the in-memory typing store and is fanned out over the
+    websockets directly; nothing is written to the database.
+    """
+    participant = await db.scalar(
+        select(ConversationParticipant.id).where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == current_user.id,
+            ConversationParticipant.is_active == True
+        )
+    )
+    if not participant:
+        raise HTTPException(status_code=403, detail="Not a participant")
+    
+    await typing_store.set_typing(
+        conversation_id, current_user.id, event.is_typing, UserResponse.from_orm(current_user).dict()
+    )
     
     return {"message": "Typing indicator sent"}
-
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, BigInteger, String, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from datetime import datetime
+from src.database.core import Base
+
+
+class ChangeLog(Base):
+    """Bounded log of chat events, written by emit_chat_event() and numbered in commit order by ChangeLogSequencer"""
+    __tablename__ = "change_log"
+    
+    seq = Column(BigInteger, primary_key=True, autoincrement=True)
+    conversation_id = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    message_id = Column(String, nullable=True)
+    user_id = Column(String, nullable=True)
+    data = Column(JSONB, nullable=True)  # Event-specific extras, e.g. read_up_to
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_change_log_conversation_seq', 'conversation_id', 'seq'),
+        Index('idx_change_log_user_seq', 'user_id', 'seq'),
+        Index('idx_change_log_created_at', 'created_at'),
+    )
@@ -21,6 +21,7 @@ class ConversationParticipant(Base):
     last_read_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)  # For removed participants
     left_at = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, default=0, server_default="0", nullable=False)  # Maintained by trigger
     
     # Relationships
     conversation = relationship("Conversation", back_populates="participants")
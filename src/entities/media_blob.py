@@ -0,0 +1,25 @@
+from sqlalchemy import Column, String, DateTime, Integer, BigInteger, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
+from datetime import datetime
+from src.database.core import Base
+
+
+class MediaBlob(Base):
+    """A stored file, keyed by the SHA-256 of its content.
+    
+    ref_count is maintained by triggers on messages.file_url and
+    users.avatar_url; unreferenced blobs are garbage collected.
+    """
+    __tablename__ = "media_blobs"
+    
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String, nullable=False)
+    ref_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)  # Last stored or referenced
+    media = Column(JSONB(none_as_null=True), nullable=True)  # Dimensions, placeholder and thumbnails once processed
+    
+    __table_args__ = (
+        Index('idx_media_blobs_unreferenced', 'last_used_at', postgresql_where=text('ref_count <= 0')),
+    )
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, String, DateTime, Integer, Text, Index, text
+from datetime import datetime
+from src.database.core import Base
+
+
+class MediaJob(Base):
+    """Pending thumbnail/preview work for a media blob, claimed by the media pipeline"""
+    __tablename__ = "media_jobs"
+    
+    sha256 = Column(String(64), primary_key=True)
+    content_type = Column(String, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, running or failed
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # Lease expiry while running
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_media_jobs_available', 'available_at', postgresql_where=text("status != 'failed'")),
+    )
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, DateTime, Boolean, ForeignKey, Text, Integer, Enum as SQLEnum
+from sqlalchemy import Column, String, DateTime, Boolean, ForeignKey, Text, Integer, Index, Enum as SQLEnum, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -26,6 +27,7 @@ class Message(Base):
     file_url = Column(String, nullable=True)  # For images, videos, files
     file_name = Column(String, nullable=True)
     file_size = Column(Integer, nullable=True)
+    media = Column(JSONB(none_as_null=True), nullable=True)  # Copied from the blob by the media pipeline
     is_edited = Column(Boolean, default=False)
     is_deleted = Column(Boolean, default=False)
     edited_at = Column(DateTime, nullable=True)
@@ -37,3 +39,9 @@ class Message(Base):
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     conversation = relationship("Conversation", back_populates="messages")
     read_receipts = relationship("MessageReadReceipt", back_populates="message")
+    
+    __table_args__ = (
+        # Keyset pagination over a conversation's visible history
+        Index('idx_messages_conversation_keyset', 'conversation_id', 'created_at', 'id',
+              postgresql_where=text('is_deleted = false')),
+    )
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, String, DateTime, Index
+from datetime import datetime
+from src.database.core import Base
+
+
+class PresenceSession(Base):
+    """A node holding at least one socket of a user, refreshed by that node's presence service"""
+    __tablename__ = "presence_sessions"
+    
+    user_id = Column(String, primary_key=True)
+    node_id = Column(String, primary_key=True)
+    last_seen = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_presence_sessions_last_seen', 'last_seen'),
+    )
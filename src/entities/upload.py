@@ -0,0 +1,22 @@
+from sqlalchemy import Column, String, DateTime, ForeignKey, Text, BigInteger
+from datetime import datetime
+import uuid
+from src.database.core import Base
+
+
+class Upload(Base):
+    """A chunked media upload; its message is only created once every byte has arrived"""
+    __tablename__ = "uploads"
+    
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
+    conversation_id = Column(String, ForeignKey("conversations.id"), nullable=False)
+    file_name = Column(String, nullable=False)
+    content_type = Column(String, nullable=False)
+    caption = Column(Text, default="")
+    total_size = Column(BigInteger, nullable=False)
+    received_size = Column(BigInteger, default=0, nullable=False)
+    sha256 = Column(String, nullable=True)  # Set on completion
+    message_id = Column(String, ForeignKey("messages.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Boolean
+from sqlalchemy import Column, String, DateTime, Boolean, Integer
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -15,6 +15,7 @@ class User(Base):
     avatar_url = Column(String)
     is_online = Column(Boolean, default=False)
     is_active = Column(Boolean, default=True)  # Soft delete
+    token_version = Column(Integer, default=0, nullable=False)  # Bumped to revoke all tokens
     last_seen = Column(DateTime, default=datetime.utcnow)
     created_at = Column(DateTime, default=datetime.utcnow)
     deleted_at = Column(DateTime, nullable=True)
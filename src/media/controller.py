@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.auth.services import get_current_user
+from src.entities.users import User
+from src.media.services import media_response, thumbnail_response
+from src.database.core import get_async_db
+
+router = APIRouter(
+    tags=["Media"]
+)
+
+
+@router.api_route("/media/{sha256}", methods=["GET", "HEAD"])
+async def download_media(sha256: str, request: Request, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Download a stored file the caller can see; supports Range and If-None-Match"""
+    return await media_response(sha256, request, current_user, db)
+
+
+@router.api_route("/media/{sha256}/thumbnails/{name}", methods=["GET", "HEAD"])
+async def download_thumbnail(sha256: str, name: str, request: Request, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Download a thumbnail listed in a message's `media`"""
+    return await thumbnail_response(sha256, name, request, current_user, db)
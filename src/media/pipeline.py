@@ -0,0 +1,154 @@
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import select, update, delete
+from typing import List, Optional
+from src.entities.media_blob import MediaBlob
+from src.entities.media_job import MediaJob
+from src.entities.message import Message
+from src.database.core import AsyncSessionLocal
+from src.media.processing import Image, render_media
+from src.media.services import blob_path, media_url
+from src.websocket.events import publish_event
+from datetime import datetime, timedelta
+import asyncio
+import multiprocessing
+import os
+
+
+# 0 disables processing on this node, e.g. API-only nodes next to dedicated workers
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_THUMBNAIL_SIZES = [int(size) for size in os.getenv("MEDIA_THUMBNAIL_SIZES", "160,480,1080").split(",")]
+MEDIA_POLL_INTERVAL = float(os.getenv("MEDIA_POLL_INTERVAL", "1"))
+MEDIA_JOB_TIMEOUT = float(os.getenv("MEDIA_JOB_TIMEOUT", "300"))
+MEDIA_JOB_MAX_ATTEMPTS = int(os.getenv("MEDIA_JOB_MAX_ATTEMPTS", "3"))
+
+
+class MediaPipeline:
+    """Renders thumbnails, placeholders and dimensions for uploaded images and videos.
+    
+    Jobs are queued in the media_jobs table by the upload, once per distinct
+    content, and claimed here with SKIP LOCKED so any number of nodes can share
+    the work. Rendering runs in a process pool; results are stored on the blob,
+    copied to every message showing it and announced with a `media_ready`
+    event. A job whose worker died is picked up again when its lease expires.
+    """
+    
+    def __init__(self):
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.failed = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if MEDIA_WORKERS <= 0:
+            return
+        if Image is None:
+            print("Pillow is not installed, media thumbnails are disabled")
+            return
+        # Spawned rather than forked from a process running an event loop
+        self.executor = ProcessPoolExecutor(MEDIA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    async def _run(self):
+        while True:
+            try:
+                jobs = await self.claim(MEDIA_WORKERS)
+            except Exception as e:
+                print(f"Error claiming media jobs: {e}")
+                jobs = []
+            if not jobs:
+                await asyncio.sleep(MEDIA_POLL_INTERVAL)
+                continue
+            await asyncio.gather(*(self.process(job) for job in jobs))
+    
+    async def claim(self, limit: int) -> List[MediaJob]:
+        now = datetime.utcnow()
+        available = select(MediaJob.sha256)\
+            .where(MediaJob.status != "failed", MediaJob.available_at <= now)\
+            .order_by(MediaJob.available_at)\
+            .limit(limit)\
+            .with_for_update(skip_locked=True)
+        async with AsyncSessionLocal() as db:
+            jobs = (await db.execute(
+                update(MediaJob)
+                .where(MediaJob.sha256.in_(available.scalar_subquery()))
+                .values(status="running", attempts=MediaJob.attempts + 1,
+                        available_at=now + timedelta(seconds=MEDIA_JOB_TIMEOUT))
+                .returning(MediaJob)
+            )).scalars().all()
+            await db.commit()
+        return list(jobs)
+    
+    async def process(self, job: MediaJob):
+        loop = asyncio.get_running_loop()
+        try:
+            rendered = await loop.run_in_executor(
+                self.executor, render_media, blob_path(job.sha256), job.content_type, MEDIA_THUMBNAIL_SIZES
+            )
+        except Exception as e:
+            await self.fail(job, e)
+            return
+        
+        url = media_url(job.sha256)
+        media = {
+            "width": rendered["width"], "height": rendered["height"], "placeholder": rendered["placeholder"],
+            "thumbnails": {size: f"{url}/thumbnails/{suffix}" for size, suffix in rendered["thumbnails"].items()}
+        }
+        try:
+            await self.attach(job.sha256, media)
+            self.processed += 1
+        except Exception as e:
+            await self.fail(job, e)
+    
+    async def attach(self, sha256: str, media: dict):
+        """Store the result on the blob and every message showing it.
+        
+        The blob row is locked first: an upload of the same content either
+        committed its message before (and it is updated here) or reads the
+        result from the blob when it stores it.
+        """
+        async with AsyncSessionLocal() as db:
+            blob = await db.scalar(select(MediaBlob).where(MediaBlob.sha256 == sha256).with_for_update())
+            if blob is not None:
+                blob.media = media
+                messages = (await db.execute(
+                    update(Message)
+                    .where(Message.file_url == media_url(sha256), Message.media == None, Message.is_deleted == False)
+                    .values(media=media)
+                    .returning(Message.id, Message.conversation_id)
+                )).all()
+                for message_id, conversation_id in messages:
+                    await publish_event(db, {
+                        "type": "media_ready", "conversation_id": conversation_id,
+                        "message_id": message_id, "media": media
+                    })
+            await db.execute(delete(MediaJob).where(MediaJob.sha256 == sha256))
+            await db.commit()
+    
+    async def fail(self, job: MediaJob, error: Exception):
+        self.failed += 1
+        print(f"Error processing media {job.sha256} (attempt {job.attempts}): {error}")
+        give_up = job.attempts >= MEDIA_JOB_MAX_ATTEMPTS
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(MediaJob)
+                .where(MediaJob.sha256 == job.sha256)
+                .values(status="failed" if give_up else "pending", error=str(error)[:1000],
+                        available_at=datetime.utcnow() + timedelta(seconds=30 * job.attempts))
+            )
+            await db.commit()
+    
+    def status(self) -> dict:
+        return {"workers": MEDIA_WORKERS if self.executor else 0, "processed": self.processed, "failed": self.failed}
+
+
+media_pipeline = MediaPipeline()
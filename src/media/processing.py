@@ -0,0 +1,146 @@
+"""Image and video rendering for the media pipeline.
+
+Runs in worker processes, so it only depends on Pillow (optional) and an
+`ffmpeg` binary for video posters, never on the app's modules.
+"""
+from typing import Dict, List
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional, without it media is not processed
+    Image = None
+
+
+PLACEHOLDER_SOURCE_SIZE = 32
+PLACEHOLDER_COMPONENTS = (4, 3)
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def encode83(value: int, length: int) -> str:
+    digits = []
+    for i in range(1, length + 1):
+        digits.append(BASE83[(value // 83 ** (length - i)) % 83])
+    return "".join(digits)
+
+
+def srgb_to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def sign_pow(value: float, exponent: float) -> float:
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash(image, x_components: int, y_components: int) -> str:
+    """BlurHash (https://blurha.sh) of a small RGB image: a ~20 character
+    placeholder clients decode into a blurred preview"""
+    width, height = image.size
+    pixels = [tuple(srgb_to_linear(c) for c in pixel) for pixel in image.getdata()]
+    
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                basis_y = math.cos(math.pi * j * y / height)
+                row = y * width
+                for x in range(width):
+                    basis = normalisation * math.cos(math.pi * i * x / width) * basis_y
+                    pr, pg, pb = pixels[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+    
+    dc, ac = factors[0], factors[1:]
+    result = encode83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = max(0, min(82, math.floor(max(abs(c) for f in ac for c in f) * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += encode83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += encode83(0, 1)
+    result += encode83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, math.floor(sign_pow(c / max_value, 0.5) * 9 + 9.5))) for c in factor)
+        result += encode83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def extract_video_frame(source_path: str, output_path: str):
+    """Grab a poster frame a second in, or the first frame of shorter clips"""
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg not available for video thumbnails")
+    for offset in ("1", "0"):
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-ss", offset, "-i", source_path, "-frames:v", "1", "-f", "image2", output_path],
+            check=True, timeout=60, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        if os.path.getsize(output_path) > 0:
+            return
+    raise RuntimeError("No video frame could be extracted")
+
+
+def render_media(source_path: str, content_type: str, sizes: List[int]) -> Dict:
+    """Write thumbnails next to `source_path` and describe the media.
+    
+    Thumbnails are written as `<source_path>.<size>.<ext>`, one per size
+    smaller than the original (videos always get one, as their poster). The
+    result has width, height, placeholder and a {size: file suffix} map.
+    """
+    if Image is None:
+        raise RuntimeError("Pillow is not installed")
+    extension = "webp" if features.check("webp") else "jpg"
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        image_path = source_path
+        is_video = content_type.startswith("video/")
+        if is_video:
+            image_path = os.path.join(workdir, "poster.jpg")
+            extract_video_frame(source_path, image_path)
+        
+        with Image.open(image_path) as image:
+            width, height = image.size
+            # EXIF orientations 5-8 are rotated by 90 degrees
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
+            # Let JPEG decode at a reduced scale when only thumbnails are needed
+            image.draft("RGB", (max(sizes), max(sizes)))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") and extension == "webp" else "RGB")
+            
+            thumbnails = {}
+            for size in sorted(sizes):
+                # Nothing to gain from upscaling, but a video needs at least its poster
+                if max(width, height) <= size and (thumbnails or not is_video):
+                    continue
+                thumbnail = image.copy()
+                thumbnail.thumbnail((size, size))
+                suffix = f"{size}.{extension}"
+                temp_path = f"{source_path}.{uuid.uuid4()}.tmp"
+                thumbnail.save(temp_path, "WEBP" if extension == "webp" else "JPEG", quality=80)
+                os.replace(temp_path, f"{source_path}.{suffix}")
+                thumbnails[str(size)] = suffix
+            
+            small = image.convert("RGB")
+            small.thumbnail((PLACEHOLDER_SOURCE_SIZE, PLACEHOLDER_SOURCE_SIZE))
+            placeholder = blurhash(small, *PLACEHOLDER_COMPONENTS)
+    
+    return {"width": width, "height": height, "placeholder": placeholder, "thumbnails": thumbnails}
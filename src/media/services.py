@@ -0,0 +1,235 @@
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+from sqlalchemy import select, exists, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Tuple
+from src.auth.services import UPLOAD_DIR
+from src.entities.media_blob import MediaBlob
+from src.entities.media_job import MediaJob
+from src.entities.message import Message
+from src.entities.conversation_participant import ConversationParticipant
+from src.entities.users import User
+from src.database.core import AsyncSessionLocal
+from datetime import datetime, timedelta
+import asyncio
+import glob
+import os
+import re
+import shutil
+import uuid
+
+
+MEDIA_DIR = f"{UPLOAD_DIR}/media"
+MEDIA_URL_PREFIX = "/media/"
+# Responses depend on who asks, so shared caches must not keep them
+MEDIA_CACHE_CONTROL = os.getenv("MEDIA_CACHE_CONTROL", "private, max-age=31536000, immutable")
+# Unreferenced blobs are kept this long so an upload can still reference what it stored
+MEDIA_GC_GRACE_HOURS = float(os.getenv("MEDIA_GC_GRACE_HOURS", "1"))
+MEDIA_GC_INTERVAL = float(os.getenv("MEDIA_GC_INTERVAL", "600"))
+MEDIA_GC_BATCH = int(os.getenv("MEDIA_GC_BATCH", "500"))
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+THUMBNAIL_PATTERN = re.compile(r"[0-9]+\.(webp|jpg)")
+
+
+def blob_path(sha256: str) -> str:
+    return f"{MEDIA_DIR}/{sha256[:2]}/{sha256}"
+
+
+def media_url(sha256: str) -> str:
+    return f"{MEDIA_URL_PREFIX}{sha256}"
+
+
+def needs_processing(content_type: str) -> bool:
+    """Whether the media pipeline renders thumbnails for this content type"""
+    return content_type.startswith("image/") or content_type.startswith("video/")
+
+
+def link_blob(source_path: str, sha256: str) -> bool:
+    """Put a file in place as its blob unless that content is already stored; blocking"""
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.link(source_path, path)
+    except FileExistsError:
+        return False
+    except OSError:
+        # No hard links across filesystems: copy, then rename into place atomically
+        temp_path = f"{path}.{uuid.uuid4()}.tmp"
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+    return True
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_blob_files(sha256: str):
+    """A blob and the thumbnails rendered from it"""
+    path = blob_path(sha256)
+    for derived in glob.glob(f"{path}.*"):
+        remove_file(derived)
+    remove_file(path)
+
+
+async def store_blob(source_path: str, sha256: str, size: int, content_type: str, db: AsyncSession) -> Tuple[str, Optional[dict]]:
+    """Register a file under its content hash; returns its media URL and its
+    processed media info when the same content was processed before.
+    
+    Identical content is stored once. The row is upserted before the file is
+    linked, so a garbage collection of the same blob either waits for this
+    transaction or has already finished and the file is put back. New images
+    and videos are queued for the media pipeline. Runs in the caller's
+    transaction; the caller commits and removes `source_path`.
+    """
+    now = datetime.utcnow()
+    media = await db.scalar(
+        pg_insert(MediaBlob)
+        .values(sha256=sha256, size=size, content_type=content_type, ref_count=0, created_at=now, last_used_at=now)
+        .on_conflict_do_update(index_elements=[MediaBlob.sha256], set_={"last_used_at": now})
+        .returning(MediaBlob.media)
+    )
+    if media is None and needs_processing(content_type):
+        await db.execute(
+            pg_insert(MediaJob)
+            .values(sha256=sha256, content_type=content_type, status="pending", attempts=0, available_at=now, created_at=now)
+            .on_conflict_do_nothing()
+        )
+    await run_in_threadpool(link_blob, source_path, sha256)
+    return media_url(sha256), media
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+async def can_access_media(sha256: str, user: User, db: AsyncSession) -> bool:
+    """Whether the user can see a message or an avatar that references the blob"""
+    url = media_url(sha256)
+    in_conversation = select(Message.id).join(ConversationParticipant, and_(
+        ConversationParticipant.conversation_id == Message.conversation_id,
+        ConversationParticipant.user_id == user.id,
+        ConversationParticipant.is_active == True
+    )).where(Message.file_url == url, Message.is_deleted == False)
+    avatar = select(User.id).where(User.avatar_url == url, User.is_active == True)
+    return await db.scalar(select(exists(in_conversation) | exists(avatar)))
+
+
+async def media_response(sha256: str, request: Request, current_user: User, db: AsyncSession):
+    """Serve a blob to a user who can see it. Content never changes under its
+    hash, so responses carry the hash as a strong ETag and are cacheable by the
+    client for good; Range requests and zero-copy sending (where the server
+    supports it) are handled by FileResponse.
+    """
+    if not SHA256_PATTERN.fullmatch(sha256):
+        raise HTTPException(status_code=404, detail="Media not found")
+    content_type = await db.scalar(select(MediaBlob.content_type).where(MediaBlob.sha256 == sha256))
+    allowed = content_type is not None and await can_access_media(sha256, current_user, db)
+    # Release the connection before streaming the file
+    await db.close()
+    # Not found rather than forbidden, so hashes of others' files can't be probed
+    if not allowed:
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    etag = f'"{sha256}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(blob_path(sha256), media_type=content_type, headers=headers)
+
+
+async def thumbnail_response(sha256: str, name: str, request: Request, current_user: User, db: AsyncSession):
+    """Serve a rendered thumbnail to a user who can see its blob; immutable like the blob"""
+    path = f"{blob_path(sha256)}.{name}"
+    if not SHA256_PATTERN.fullmatch(sha256) or not THUMBNAIL_PATTERN.fullmatch(name):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    allowed = await can_access_media(sha256, current_user, db)
+    await db.close()
+    if not allowed or not await run_in_threadpool(os.path.isfile, path):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    etag = f'"{sha256}.{name}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
+
+async def collect_garbage(db: AsyncSession) -> int:
+    """Delete unreferenced blobs past the grace period, files first.
+    
+    The rows stay locked until the files are gone, so a concurrent upload of
+    the same content waits and then stores it again. References are re-checked
+    against messages and users rather than trusting ref_count alone.
+    """
+    cutoff = datetime.utcnow() - timedelta(hours=MEDIA_GC_GRACE_HOURS)
+    blobs = (await db.execute(
+        select(MediaBlob)
+        .where(MediaBlob.ref_count <= 0, MediaBlob.last_used_at < cutoff)
+        .order_by(MediaBlob.last_used_at)
+        .limit(MEDIA_GC_BATCH)
+        .with_for_update(skip_locked=True)
+    )).scalars().all()
+    if not blobs:
+        await db.commit()
+        return 0
+    
+    urls = [media_url(blob.sha256) for blob in blobs]
+    referenced = set((await db.execute(
+        select(Message.file_url).where(Message.file_url.in_(urls), Message.is_deleted == False)
+        .union(select(User.avatar_url).where(User.avatar_url.in_(urls)))
+    )).scalars().all())
+    
+    removed = 0
+    for blob in blobs:
+        if media_url(blob.sha256) in referenced:
+            print(f"Media blob {blob.sha256} is referenced but has ref_count {blob.ref_count}, keeping it")
+            continue
+        await run_in_threadpool(remove_blob_files, blob.sha256)
+        await db.delete(blob)
+        removed += 1
+    await db.commit()
+    return removed
+
+
+class MediaCollector:
+    """Background task removing unreferenced blobs every MEDIA_GC_INTERVAL seconds"""
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(MEDIA_GC_INTERVAL)
+            try:
+                async with AsyncSessionLocal() as db:
+                    removed = await collect_garbage(db)
+                if removed:
+                    print(f"Removed {removed} unreferenced media blobs")
+            except Exception as e:
+                print(f"Error collecting media: {e}")
+
+
+media_collector = MediaCollector()
@@ -1,12 +1,12 @@
-from fastapi import APIRouter, Depends, UploadFile, File
-from sqlalchemy.orm import Session
-from typing import List
-from src.message.models import MessageCreate, MessageResponse, MessageEdit
+from fastapi import APIRouter, Depends, UploadFile, File, Query, Request, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.message.models import MessageCreate, MessageResponse, MessageEdit, MessagePage, ReadUpToRequest, UploadCreate, UploadStatus
 from src.auth.services import get_current_user
 from src.entities.users import User
 from typing import Optional
-from src.database.core import get_db
-from src.message.services import send_messages, get_all_messages, mark_message_as_read, send_media_messages, edit_messages, delete_messages
+from src.database.core import get_async_db
+from src.message.services import send_messages, get_all_messages, mark_message_as_read, mark_conversation_read, send_media_messages, edit_messages, delete_messages
+from src.message.services import create_upload, get_upload, write_upload_chunk, complete_upload, cancel_upload, UPLOAD_CHUNK_SIZE
 
 router = APIRouter(
     tags=["Messaging"]
@@ -15,46 +15,99 @@ router = APIRouter(
 
 
 @router.post("/messages", response_model=MessageResponse)
-def send_message(message: MessageCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def send_message(message: MessageCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
-    return send_messages(message, current_user, db)
+    return await send_messages(message, current_user, db)
 
 
 @router.post("/messages/upload")
-def send_media_message(
+async def send_media_message(
     conversation_id: str,
     file: UploadFile = File(...),
     caption: str = "",
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    return send_media_messages(conversation_id, file, caption, current_user, db)
+    return await send_media_messages(conversation_id, file, caption, current_user, db)
 
-@router.get("/conversations/{conversation_id}/messages", response_model=List[MessageResponse])
-def get_messages(conversation_id: str, limit: int = 50, before: Optional[str] = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
 
-    return get_all_messages(conversation_id, limit, before, current_user, db)
+@router.post("/messages/uploads", response_model=UploadStatus)
+async def start_upload(request: UploadCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    return await create_upload(request, current_user, db)
+
+
+@router.get("/messages/uploads/{upload_id}", response_model=UploadStatus)
+async def get_upload_progress(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    return await get_upload(upload_id, current_user, db)
+
+
+@router.put("/messages/uploads/{upload_id}", response_model=UploadStatus)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Raw chunk bytes as the request body"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Chunk larger than {UPLOAD_CHUNK_SIZE} bytes")
+    return await write_upload_chunk(upload_id, offset, request.stream(), current_user, db)
+
+
+@router.post("/messages/uploads/{upload_id}/complete", response_model=MessageResponse)
+async def finish_upload(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    return await complete_upload(upload_id, current_user, db)
+
+
+@router.delete("/messages/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    return await cancel_upload(upload_id, current_user, db)
+
+@router.get("/conversations/{conversation_id}/messages", response_model=MessagePage)
+async def get_messages(
+    conversation_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+
+    return await get_all_messages(conversation_id, limit, before, after, around, current_user, db)
 
 @router.post("/messages/{message_id}/read")
-def mark_message_read(message_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def mark_message_read(message_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
    
-    return mark_message_as_read(message_id, current_user, db)
+    return await mark_message_as_read(message_id, current_user, db)
+
+
+@router.post("/conversations/{conversation_id}/read")
+async def mark_conversation_as_read(
+    conversation_id: str,
+    request: ReadUpToRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await mark_conversation_read(conversation_id, request, current_user, db)
 
 
 @router.patch("/messages/{message_id}", response_model=MessageResponse)
-def edit_message(
+async def edit_message(
     message_id: str,
     edit: MessageEdit,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    return edit_messages(message_id, edit, current_user, db)
+    return await edit_messages(message_id, edit, current_user, db)
 
 @router.delete("/messages/{message_id}")
-def delete_message(
+async def delete_message(
     message_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    return delete_messages(message_id, current_user, db)
\ No newline at end of file
+    return await delete_messages(message_id, current_user, db)
\ No newline at end of file
@@ -11,6 +11,9 @@ class MessageCreate(BaseModel):
 class MessageEdit(BaseModel):
     content: str
 
+class ReadUpToRequest(BaseModel):
+    message_id: str
+
 class MessageResponse(BaseModel):
     id: str
     conversation_id: str
@@ -20,14 +23,40 @@ class MessageResponse(BaseModel):
     file_url: Optional[str]
     file_name: Optional[str]
     file_size: Optional[int]
+    media: Optional[dict] = None  # width, height, placeholder and thumbnail URLs, once processed
     is_edited: bool
     is_deleted: bool
     edited_at: Optional[datetime]
     created_at: datetime
     sender: UserResponse
     read_by: List[str] = []
+    read_count: int = 0
     
     class Config:
         from_attributes = True
 
 
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    older_cursor: Optional[str] = None
+    newer_cursor: Optional[str] = None
+
+
+class UploadCreate(BaseModel):
+    conversation_id: str
+    file_name: str
+    content_type: str
+    size: int
+    caption: str = ""
+
+
+class UploadStatus(BaseModel):
+    id: str
+    conversation_id: str
+    file_name: str
+    total_size: int
+    received_size: int
+    chunk_size: int  # Largest chunk accepted per PUT
+    expires_at: datetime
+    sha256: Optional[str] = None
+    message_id: Optional[str] = None
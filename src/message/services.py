@@ -1,28 +1,55 @@
 from fastapi import Depends, HTTPException, UploadFile, File
-from sqlalchemy.orm import Session
-from typing import List
-from src.message.models import MessageCreate, MessageResponse, MessageEdit
-from src.auth.services import get_current_user, save_upload_file
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, insert, update, exists, literal, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import AsyncIterator, Dict, List, Tuple
+from src.message.models import MessageCreate, MessageResponse, MessageEdit, MessagePage, ReadUpToRequest, UploadCreate, UploadStatus
+from src.auth.services import get_current_user, save_upload_file, UPLOAD_DIR, MAX_UPLOAD_SIZE
+from src.media.services import store_blob, remove_file
 from src.entities.users import User
 from src.entities.conversation_participant import ConversationParticipant
 from src.entities.message import Message, MessageType
 from src.entities.conversation import Conversation
 from src.entities.message_read_receipt import MessageReadReceipt
 from src.entities.typing_indicator import TypingIndicator
-from datetime import datetime
+from src.entities.upload import Upload
+from datetime import datetime, timedelta
+import asyncio
+import base64
+import hashlib
+import uuid
 from typing import Optional
-from src.database.core import get_db
+from src.database.core import get_async_db, AsyncSessionLocal
+from src.websocket.events import publish_event
+import os
 
 
+READ_RECEIPT_ROW_LIMIT = int(os.getenv("READ_RECEIPT_ROW_LIMIT", "32"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_EXPIRE_HOURS = float(os.getenv("UPLOAD_EXPIRE_HOURS", "24"))
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "600"))
+UPLOAD_SWEEP_BATCH = 500
+UPLOAD_WRITE_BUFFER = 1024 * 1024
 
-def send_messages(message: MessageCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+
+async def load_message(message_id: str, db: AsyncSession) -> Optional[Message]:
+    """Load a message with its sender so it can be serialized outside the session"""
+    return await db.scalar(
+        select(Message).options(selectinload(Message.sender)).where(Message.id == message_id)
+    )
+
+
+async def send_messages(message: MessageCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
     """Send a message"""
     # Verify user is participant
-    participant = db.query(ConversationParticipant).filter(
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == message.conversation_id,
             ConversationParticipant.user_id == current_user.id
-        ).first()
+        )
+    )
     
     if not participant:
         raise HTTPException(status_code=403, detail="Not a participant")
@@ -37,150 +64,610 @@ def send_messages(message: MessageCreate, current_user: User = Depends(get_curre
     db.add(db_message)
     
     # Update conversation timestamp
-    conversation = db.query(Conversation).filter(Conversation.id == message.conversation_id).first()
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == message.conversation_id))
     conversation.updated_at = datetime.utcnow()
     
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
     
-    return db_message
+    return await load_message(db_message.id, db)
+
+
+def uses_receipt_rows(member_count: int) -> bool:
+    """Small conversations also keep one receipt row per reader; watermarks cover every size"""
+    return member_count <= READ_RECEIPT_ROW_LIMIT
+
+
+async def get_read_watermarks(conversation_id: str, db: AsyncSession) -> List[Tuple[datetime, str, datetime]]:
+    """(last_read_at, user_id, joined_at) of every active participant, most recent reader first"""
+    rows = (await db.execute(
+        select(ConversationParticipant.last_read_at, ConversationParticipant.user_id, ConversationParticipant.joined_at)
+        .where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.is_active == True
+        )
+    )).all()
+    return sorted(
+        ((last_read_at or datetime.min, user_id, joined_at or datetime.min) for last_read_at, user_id, joined_at in rows),
+        reverse=True
+    )
+
+
+def readers_from_watermarks(message: Message, watermarks: List[Tuple[datetime, str, datetime]]) -> List[str]:
+    """Everyone who was a member when the message was sent and whose watermark is at or past it, except its sender"""
+    read_by = []
+    for last_read_at, user_id, joined_at in watermarks:
+        if last_read_at < message.created_at:
+            break
+        if user_id != message.sender_id and joined_at <= message.created_at:
+            read_by.append(user_id)
+    return read_by
 
 
-def get_all_messages(
+async def get_readers(message_ids: List[str], db: AsyncSession) -> Dict[str, List[str]]:
+    """Reader IDs of each message from its receipt rows, aggregated in one query"""
+    if not message_ids:
+        return {}
+    rows = await db.execute(
+        select(MessageReadReceipt.message_id, func.array_agg(MessageReadReceipt.user_id))
+        .where(MessageReadReceipt.message_id.in_(message_ids))
+        .group_by(MessageReadReceipt.message_id)
+    )
+    return {message_id: user_ids for message_id, user_ids in rows}
+
+
+def encode_cursor(message: Message) -> str:
+    """Opaque pagination cursor for a message's (created_at, id) position"""
+    raw = f"{message.created_at.isoformat()}|{message.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), message_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_all_messages(
     conversation_id: str,
     limit: int = 50,
     before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get messages from conversation"""
-    participant = db.query(ConversationParticipant)\
-        .filter(
-            ConversationParticipant.conversation_id == conversation_id,
-            ConversationParticipant.user_id == current_user.id,
-            ConversationParticipant.is_active == True
-        ).first()
+    """Get a page of messages using keyset pagination on (created_at, id).
     
-    if not participant:
+    `before`/`after` take a cursor from a previous page, `around` takes a message
+    id and returns the page centred on it (jump-to-message). Without any of them
+    the latest messages are returned.
+    """
+    if sum(x is not None for x in (before, after, around)) > 1:
+        raise HTTPException(status_code=400, detail="Use only one of before, after or around")
+    
+    watermarks = await get_read_watermarks(conversation_id, db)
+    if current_user.id not in {user_id for _, user_id, _ in watermarks}:
         raise HTTPException(status_code=403, detail="Not a participant")
+    use_receipt_rows = uses_receipt_rows(len(watermarks))
+    
+    query = select(Message)\
+        .options(selectinload(Message.sender))\
+        .where(Message.conversation_id == conversation_id, Message.is_deleted == False)
+    position = tuple_(Message.created_at, Message.id)
+    newest_first = (Message.created_at.desc(), Message.id.desc())
+    oldest_first = (Message.created_at.asc(), Message.id.asc())
     
-    query = db.query(Message)\
-        .filter(Message.conversation_id == conversation_id, Message.is_deleted == False)
+    async def fetch(stmt, size):
+        return list((await db.execute(stmt.limit(size + 1))).scalars().all())
     
-    if before:
-        query = query.filter(Message.id < before)
+    async def any_message(condition):
+        return await db.scalar(select(exists().where(
+            Message.conversation_id == conversation_id, Message.is_deleted == False, condition
+        )))
     
-    messages = query.order_by(Message.created_at.desc()).limit(limit).all()
+    if around:
+        target = await db.scalar(query.where(Message.id == around))
+        if not target:
+            raise HTTPException(status_code=404, detail="Message not found")
+        older_size = limit // 2
+        newer_size = limit - older_size - 1
+        older = await fetch(query.where(position < tuple_(target.created_at, target.id)).order_by(*newest_first), older_size)
+        newer = await fetch(query.where(position > tuple_(target.created_at, target.id)).order_by(*oldest_first), newer_size)
+        has_older, has_newer = len(older) > older_size, len(newer) > newer_size
+        messages = list(reversed(older[:older_size])) + [target] + newer[:newer_size]
+    elif after:
+        cursor = tuple_(*decode_cursor(after))
+        newer = await fetch(query.where(position > cursor).order_by(*oldest_first), limit)
+        # The cursor's own message may have been deleted since, or it was the only one
+        has_older = bool(newer) and await any_message(position <= cursor)
+        has_newer = len(newer) > limit
+        messages = newer[:limit]
+    else:
+        if before:
+            cursor = tuple_(*decode_cursor(before))
+            query = query.where(position < cursor)
+        older = await fetch(query.order_by(*newest_first), limit)
+        has_older = len(older) > limit
+        has_newer = before is not None and bool(older) and await any_message(position >= cursor)
+        messages = list(reversed(older[:limit]))
     
-    # Add read_by info
+    # Add read_by info. Receipt rows also remember readers who have since left;
+    # watermarks cover messages read while the conversation was too large for rows
+    receipts = await get_readers([msg.id for msg in messages], db) if use_receipt_rows else {}
     result = []
-    for msg in reversed(messages):
-        read_by = [r.user_id for r in msg.read_receipts]
-        msg_dict = MessageResponse.from_orm(msg).dict()
-        msg_dict['read_by'] = read_by
-        result.append(MessageResponse(**msg_dict))
+    for msg in messages:
+        read_by = list(receipts.get(msg.id, []))
+        read_by += [user_id for user_id in readers_from_watermarks(msg, watermarks) if user_id not in read_by]
+        response = MessageResponse.from_orm(msg)
+        response.read_by = read_by
+        response.read_count = len(read_by)
+        result.append(response)
     
-    return result
+    return MessagePage(
+        messages=result,
+        older_cursor=encode_cursor(messages[0]) if has_older and messages else None,
+        newer_cursor=encode_cursor(messages[-1]) if has_newer and messages else None
+    )
 
 
-def mark_message_as_read(message_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def mark_message_as_read(message_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
-    """Mark message as read"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    """Mark message as read (and everything before it)"""
+    message = await db.scalar(select(Message).where(Message.id == message_id))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    # Check if already read
-    existing = db.query(MessageReadReceipt).filter(
-            MessageReadReceipt.message_id == message_id,
-            MessageReadReceipt.user_id == current_user.id
-        ).first()
+    return await mark_conversation_read(message.conversation_id, ReadUpToRequest(message_id=message_id), current_user, db)
+
+
+async def mark_conversation_read(
+    conversation_id: str,
+    request: ReadUpToRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Advance my read watermark up to a message.
+    
+    In small conversations receipts for every newly read message are inserted
+    with one INSERT ... SELECT; larger ones only move the watermark. Either way a
+    single aggregated message_read event is published.
+    """
+    # Locked so a message committed during the recount below can't have its
+    # unread_count +1 overwritten: its trigger waits for our commit instead
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == current_user.id,
+            ConversationParticipant.is_active == True
+        ).with_for_update()
+    )
     
-    if existing:
-        return {"message": "Already marked as read"}
+    if not participant:
+        raise HTTPException(status_code=403, detail="Not a participant")
     
-    # Create read receipt
-    receipt = MessageReadReceipt(
-        message_id=message_id,
-        user_id=current_user.id
+    message = await db.scalar(
+        select(Message).where(Message.id == request.message_id, Message.conversation_id == conversation_id)
     )
-    db.add(receipt)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
     
-    # Update last_read_at
-    participant = db.query(ConversationParticipant).filter(
-            ConversationParticipant.conversation_id == message.conversation_id,
-            ConversationParticipant.user_id == current_user.id
-        ).first()
+    watermark = message.created_at
+    if participant.last_read_at and participant.last_read_at >= watermark:
+        return {"message": "Already marked as read", "last_read_at": participant.last_read_at}
+    
+    read_at = datetime.utcnow()
+    newly_read = select(Message.id, literal(current_user.id), literal(read_at))\
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.created_at <= watermark,
+            Message.sender_id != current_user.id,
+            Message.is_deleted == False,
+            ~exists().where(
+                MessageReadReceipt.message_id == Message.id,
+                MessageReadReceipt.user_id == current_user.id
+            )
+        )
+    if participant.last_read_at:
+        newly_read = newly_read.where(Message.created_at > participant.last_read_at)
+    
+    member_count = await db.scalar(
+        select(func.count(ConversationParticipant.id)).where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.is_active == True
+        )
+    )
+    if uses_receipt_rows(member_count):
+        await db.execute(
+            insert(MessageReadReceipt).from_select(["message_id", "user_id", "read_at"], newly_read)
+        )
     
-    if participant:
-        participant.last_read_at = datetime.utcnow()
+    participant.last_read_at = watermark
+    participant.unread_count = await db.scalar(
+        select(func.count(Message.id)).where(
+            Message.conversation_id == conversation_id,
+            Message.created_at > watermark,
+            Message.sender_id != current_user.id,
+            Message.is_deleted == False
+        )
+    )
     
-    db.commit()
+    await publish_event(db, {
+        "type": "message_read", "conversation_id": conversation_id, "user_id": current_user.id,
+        "message_id": message.id, "read_at": read_at, "read_up_to": watermark
+    })
+    await db.commit()
     
-    return {"message": "Message marked as read"}
+    return {"message": "Messages marked as read", "last_read_at": watermark, "unread_count": participant.unread_count}
 
 
 
-def send_media_messages(
+def classify_media(content_type: str) -> MessageType:
+    if content_type.startswith("image/"):
+        return MessageType.IMAGE
+    if content_type.startswith("video/"):
+        return MessageType.VIDEO
+    return MessageType.FILE
+
+
+async def send_media_messages(
     conversation_id: str,
     file: UploadFile = File(...),
     caption: str = "",
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Send image/video/file message"""
-    participant = db.query(ConversationParticipant)\
-        .filter(
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == current_user.id,
             ConversationParticipant.is_active == True
-        ).first()
+        )
+    )
     
     if not participant:
         raise HTTPException(status_code=403, detail="Not a participant")
     
-    # Determine message type and subfolder
-    content_type = file.content_type
-    if content_type.startswith("image/"):
-        message_type = MessageType.IMAGE
-        subfolder = "images"
-    elif content_type.startswith("video/"):
-        message_type = MessageType.VIDEO
-        subfolder = "videos"
-    else:
-        message_type = MessageType.FILE
-        subfolder = "files"
-    
     # Save file
-    file_path, file_size = save_upload_file(file, subfolder)
+    temp_path, file_size, sha256 = await run_in_threadpool(save_upload_file, file)
+    try:
+        file_url, media = await store_blob(temp_path, sha256, file_size, file.content_type, db)
+        
+        # Create message
+        db_message = Message(
+            conversation_id=conversation_id,
+            sender_id=current_user.id,
+            content=caption or file.filename,
+            message_type=classify_media(file.content_type),
+            file_url=file_url,
+            file_name=file.filename,
+            file_size=file_size,
+            media=media
+        )
+        db.add(db_message)
+        
+        conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
+        conversation.updated_at = datetime.utcnow()
+        
+        await db.commit()
+    finally:
+        await run_in_threadpool(remove_file, temp_path)
+    return await load_message(db_message.id, db)
+
+class UploadProgress:
+    """Per-process state of an upload between chunks: a lock ordering its
+    requests and the running hash of the bytes received so far. Requests on
+    other workers are ordered by the upload's row instead."""
+    __slots__ = ("lock", "hasher", "offset")
     
-    # Create message
-    db_message = Message(
-        conversation_id=conversation_id,
-        sender_id=current_user.id,
-        content=caption or file.filename,
-        message_type=message_type,
-        file_url=f"/{file_path}",
-        file_name=file.filename,
-        file_size=file_size
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+
+
+upload_progress: Dict[str, UploadProgress] = {}
+
+
+def partial_path(upload_id: str) -> str:
+    return f"{UPLOAD_DIR}/partial/{upload_id}.part"
+
+
+def chunk_path(upload_id: str) -> str:
+    """A private spool file for one chunk request"""
+    return f"{UPLOAD_DIR}/partial/{upload_id}.{uuid.uuid4().hex}.chunk"
+
+
+def open_partial(path: str, offset: int):
+    """Open a partial upload for writing at `offset`, dropping anything a failed chunk left past it"""
+    file = open(path, "r+b")
+    file.truncate(offset)
+    file.seek(offset)
+    return file
+
+
+def append_and_hash(path: str, offset: int, chunk: str, hasher):
+    """Copy a spooled chunk into the partial upload at `offset`, hashing it"""
+    with open(chunk, "rb") as source:
+        file = open_partial(path, offset)
+        try:
+            while data := source.read(UPLOAD_WRITE_BUFFER):
+                file.write(data)
+                hasher.update(data)
+        finally:
+            file.close()
+
+
+def hash_prefix(path: str, size: int):
+    """Rebuild the running hash from disk, e.g. after a restart or on another worker"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        while size > 0:
+            data = file.read(min(UPLOAD_WRITE_BUFFER, size))
+            if not data:
+                break
+            hasher.update(data)
+            size -= len(data)
+    return hasher
+
+
+def upload_status(upload: Upload) -> UploadStatus:
+    return UploadStatus(
+        id=upload.id, conversation_id=upload.conversation_id, file_name=upload.file_name,
+        total_size=upload.total_size, received_size=upload.received_size, chunk_size=UPLOAD_CHUNK_SIZE,
+        expires_at=upload.expires_at, sha256=upload.sha256, message_id=upload.message_id
     )
-    db.add(db_message)
+
+
+async def get_active_participant(conversation_id: str, user_id: str, db: AsyncSession) -> ConversationParticipant:
+    participant = await db.scalar(
+        select(ConversationParticipant).where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == user_id,
+            ConversationParticipant.is_active == True
+        )
+    )
+    if not participant:
+        raise HTTPException(status_code=403, detail="Not a participant")
+    return participant
+
+
+async def discard_expired_uploads(db: AsyncSession, user_id: Optional[str] = None) -> int:
+    """Delete unfinished uploads past their expiry (of one user, or anyone's), skipping ones in use"""
+    query = select(Upload).where(Upload.message_id == None, Upload.expires_at < datetime.utcnow())
+    if user_id:
+        query = query.where(Upload.user_id == user_id)
+    expired = (await db.execute(
+        query.limit(UPLOAD_SWEEP_BATCH).with_for_update(skip_locked=True)
+    )).scalars().all()
+    for upload in expired:
+        await run_in_threadpool(remove_file, partial_path(upload.id))
+        upload_progress.pop(upload.id, None)
+        await db.delete(upload)
+    return len(expired)
+
+
+class UploadSweeper:
+    """Background task removing abandoned chunked uploads every UPLOAD_SWEEP_INTERVAL seconds"""
     
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-    conversation.updated_at = datetime.utcnow()
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+            try:
+                async with AsyncSessionLocal() as db:
+                    removed = await discard_expired_uploads(db)
+                    await db.commit()
+                if removed:
+                    print(f"Removed {removed} expired uploads")
+            except Exception as e:
+                print(f"Error sweeping uploads: {e}")
+
+
+upload_sweeper = UploadSweeper()
+
+
+async def create_upload(request: UploadCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Start a chunked upload of a media message"""
+    if request.size <= 0:
+        raise HTTPException(status_code=400, detail="Size must be positive")
+    if request.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"File larger than {MAX_UPLOAD_SIZE} bytes")
+    await get_active_participant(request.conversation_id, current_user.id, db)
+    
+    await discard_expired_uploads(db, current_user.id)
+    upload = Upload(
+        user_id=current_user.id,
+        conversation_id=request.conversation_id,
+        file_name=request.file_name,
+        content_type=request.content_type,
+        caption=request.caption,
+        total_size=request.size,
+        expires_at=datetime.utcnow() + timedelta(hours=UPLOAD_EXPIRE_HOURS)
+    )
+    db.add(upload)
+    await db.flush()
+    await run_in_threadpool(lambda: open(partial_path(upload.id), "wb").close())
+    await db.commit()
+    return upload_status(upload)
+
+
+async def get_own_upload(upload_id: str, current_user: User, db: AsyncSession, lock: bool = False) -> Upload:
+    # populate_existing: re-read under the upload's lock even if already loaded
+    query = select(Upload).where(Upload.id == upload_id, Upload.user_id == current_user.id)\
+        .execution_options(populate_existing=True)
+    if lock:
+        # Waits for a chunk being appended on any worker
+        query = query.with_for_update()
+    upload = await db.scalar(query)
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if not upload.message_id and upload.expires_at < datetime.utcnow():
+        raise HTTPException(status_code=410, detail="Upload expired")
+    return upload
+
+
+async def get_upload(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Upload progress; a client resumes by sending the next chunk at `received_size`"""
+    return upload_status(await get_own_upload(upload_id, current_user, db))
+
+
+async def write_upload_chunk(
+    upload_id: str,
+    offset: int,
+    body: AsyncIterator[bytes],
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Append the next chunk of an upload.
+    
+    `offset` must equal the bytes received so far. The body is spooled to its
+    own file in the threadpool, and rejected as soon as it grows past the chunk
+    size or the declared file size. The offset is then claimed with a
+    conditional UPDATE, whose row lock is held while the chunk is appended, so
+    requests racing for the same offset on any worker get a 409. A failed
+    chunk leaves the upload at its previous offset.
+    """
+    # Checked before creating any state so unknown IDs leave nothing behind
+    await get_own_upload(upload_id, current_user, db)
+    progress = upload_progress.setdefault(upload_id, UploadProgress())
+    async with progress.lock:
+        upload = await get_own_upload(upload_id, current_user, db)
+        if upload.message_id:
+            raise HTTPException(status_code=409, detail="Upload already completed")
+        if offset != upload.received_size:
+            raise HTTPException(status_code=409, detail=f"Expected offset {upload.received_size}")
+        limit = min(UPLOAD_CHUNK_SIZE, upload.total_size - offset)
+        # Don't hold a pooled connection while a slow client sends the body
+        await db.commit()
+        
+        received = 0
+        buffer = bytearray()
+        chunk = chunk_path(upload_id)
+        file = await run_in_threadpool(open, chunk, "wb")
+        try:
+            try:
+                async for data in body:
+                    received += len(data)
+                    if received > limit:
+                        raise HTTPException(status_code=413, detail=f"Chunk larger than {limit} bytes")
+                    buffer += data
+                    if len(buffer) >= UPLOAD_WRITE_BUFFER:
+                        await run_in_threadpool(file.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await run_in_threadpool(file.write, bytes(buffer))
+            finally:
+                await run_in_threadpool(file.close)
+            
+            claimed = await db.execute(
+                update(Upload).where(
+                    Upload.id == upload_id, Upload.received_size == offset,
+                    Upload.message_id == None, Upload.expires_at >= datetime.utcnow()
+                ).values(received_size=offset + received)
+            )
+            if claimed.rowcount != 1:
+                upload = await get_own_upload(upload_id, current_user, db)
+                raise HTTPException(status_code=409, detail=f"Expected offset {upload.received_size}")
+            
+            path = partial_path(upload_id)
+            if progress.offset != offset:
+                # Another worker wrote the previous chunk
+                progress.hasher = await run_in_threadpool(hash_prefix, path, offset)
+                progress.offset = offset
+            hasher = progress.hasher.copy()
+            await run_in_threadpool(append_and_hash, path, offset, chunk, hasher)
+            await db.commit()
+        finally:
+            await run_in_threadpool(remove_file, chunk)
+        
+        progress.hasher, progress.offset = hasher, offset + received
+        return upload_status(await get_own_upload(upload_id, current_user, db))
+
+
+async def complete_upload(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Turn a fully received upload into its message; repeating the call returns the same message"""
+    await get_own_upload(upload_id, current_user, db)
+    progress = upload_progress.setdefault(upload_id, UploadProgress())
+    async with progress.lock:
+        upload = await get_own_upload(upload_id, current_user, db, lock=True)
+        if upload.message_id:
+            upload_progress.pop(upload_id, None)
+            return await load_message(upload.message_id, db)
+        if upload.received_size != upload.total_size:
+            raise HTTPException(status_code=409, detail=f"Upload incomplete, {upload.received_size} of {upload.total_size} bytes received")
+        await get_active_participant(upload.conversation_id, current_user.id, db)
+        
+        path = partial_path(upload_id)
+        if progress.offset != upload.received_size:
+            progress.hasher = await run_in_threadpool(hash_prefix, path, upload.received_size)
+        
+        sha256 = progress.hasher.hexdigest()
+        file_url, media = await store_blob(path, sha256, upload.total_size, upload.content_type, db)
+        db_message = Message(
+            conversation_id=upload.conversation_id,
+            sender_id=current_user.id,
+            content=upload.caption or upload.file_name,
+            message_type=classify_media(upload.content_type),
+            file_url=file_url,
+            file_name=upload.file_name,
+            file_size=upload.total_size,
+            media=media
+        )
+        db.add(db_message)
+        await db.flush()
+        
+        upload.message_id = db_message.id
+        upload.sha256 = sha256
+        conversation = await db.scalar(select(Conversation).where(Conversation.id == upload.conversation_id))
+        conversation.updated_at = datetime.utcnow()
+        await db.commit()
+        # Only once committed, so a failed completion can be retried
+        await run_in_threadpool(remove_file, path)
     
-    db.commit()
-    db.refresh(db_message)
-    return db_message
+    upload_progress.pop(upload_id, None)
+    return await load_message(db_message.id, db)
+
+
+async def cancel_upload(upload_id: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Abandon an unfinished upload"""
+    await get_own_upload(upload_id, current_user, db)
+    progress = upload_progress.setdefault(upload_id, UploadProgress())
+    async with progress.lock:
+        upload = await get_own_upload(upload_id, current_user, db, lock=True)
+        if upload.message_id:
+            raise HTTPException(status_code=409, detail="Upload already completed")
+        await db.delete(upload)
+        await db.commit()
+        await run_in_threadpool(remove_file, partial_path(upload_id))
+    upload_progress.pop(upload_id, None)
+    return {"message": "Upload cancelled"}
+
 
-def edit_messages(
+async def edit_messages(
     message_id: str,
     edit: MessageEdit,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Edit message (sender only)"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await load_message(message_id, db)
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -194,18 +681,17 @@ def edit_messages(
     message.is_edited = True
     message.edited_at = datetime.utcnow()
     
-    db.commit()
-    db.refresh(message)
+    await db.commit()
     return message
 
 
-def delete_messages(
+async def delete_messages(
     message_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete message (sender only)"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.scalar(select(Message).where(Message.id == message_id))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -216,5 +702,5 @@ def delete_messages(
     message.deleted_at = datetime.utcnow()
     message.content = "This message was deleted"
     
-    db.commit()
-    return {"message": "Message deleted"}
\ No newline at end of file
+    await db.commit()
+    return {"message": "Message deleted"}
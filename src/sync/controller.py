@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from src.sync.models import SyncResponse
+from src.sync.services import get_changes
+from src.auth.services import get_current_user
+from src.entities.users import User
+from src.database.core import get_async_db
+
+router = APIRouter(
+    tags=["Sync"]
+)
+
+
+@router.get("/sync", response_model=SyncResponse)
+async def sync(
+    since: Optional[int] = Query(None, ge=0),
+    limit: int = Query(500, ge=1, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Catch up on what happened since a checkpoint, e.g. after a reconnect"""
+    return await get_changes(since, limit, current_user, db)
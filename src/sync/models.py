@@ -0,0 +1,23 @@
+from pydantic import BaseModel
+from typing import Optional, List
+from datetime import datetime
+from src.message.models import MessageResponse
+
+class ChangeResponse(BaseModel):
+    seq: int
+    type: str
+    conversation_id: str
+    message_id: Optional[str]
+    user_id: Optional[str]
+    data: Optional[dict]
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+
+class SyncResponse(BaseModel):
+    changes: List[ChangeResponse]
+    messages: List[MessageResponse]  # Current state of the messages the changes refer to
+    next_since: int
+    has_more: bool
@@ -0,0 +1,187 @@
+from fastapi import Depends, HTTPException
+from sqlalchemy import select, delete, func, or_, and_, event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from typing import Optional
+from src.sync.models import ChangeResponse, SyncResponse
+from src.message.models import MessageResponse
+from src.auth.services import get_current_user
+from src.entities.users import User
+from src.entities.change_log import ChangeLog
+from src.entities.conversation_participant import ConversationParticipant
+from src.entities.message import Message
+from src.database.core import get_async_db, AsyncSessionLocal, ASYNC_DATABASE_URL
+from datetime import datetime, timedelta
+import asyncpg
+import asyncio
+import os
+
+
+CHANGE_LOG_RETENTION_HOURS = float(os.getenv("CHANGE_LOG_RETENTION_HOURS", "72"))
+CHANGE_LOG_PRUNE_INTERVAL = float(os.getenv("CHANGE_LOG_PRUNE_INTERVAL", "600"))
+CHANGE_LOG_SEQUENCE_BATCH = int(os.getenv("CHANGE_LOG_SEQUENCE_BATCH", "1000"))
+# Picks up events committed outside this node's sessions, e.g. by a node that died
+CHANGE_LOG_SEQUENCE_INTERVAL = float(os.getenv("CHANGE_LOG_SEQUENCE_INTERVAL", "1"))
+
+MESSAGE_EVENTS = ("new_message", "message_edited", "message_deleted", "media_ready")
+MEMBERSHIP_EVENTS = ("participant_added", "participant_removed")
+
+
+async def get_changes(
+    since: Optional[int] = None,
+    limit: int = 500,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Changes after sequence number `since` in my conversations, oldest first.
+    
+    Without `since` only the current checkpoint is returned, to be taken before
+    a full load. A checkpoint older than the retained log gets a 410 and the
+    client has to load everything again.
+    """
+    if since is None:
+        # Events are numbered in commit order, so nothing can appear below it later.
+        # Not yet sequenced events have a negative seq and are left out everywhere.
+        latest = await db.scalar(select(func.max(ChangeLog.seq)).where(ChangeLog.seq > 0))
+        return SyncResponse(changes=[], messages=[], next_since=latest or 0, has_more=False)
+    
+    oldest = await db.scalar(select(func.min(ChangeLog.seq)).where(ChangeLog.seq > 0))
+    if oldest is not None and since < oldest - 1:
+        raise HTTPException(status_code=410, detail="Checkpoint expired, full resync required")
+    
+    my_conversations = select(ConversationParticipant.conversation_id).where(
+        ConversationParticipant.user_id == current_user.id,
+        ConversationParticipant.is_active == True
+    )
+    changes = list((await db.execute(
+        select(ChangeLog)
+        .where(
+            ChangeLog.seq > since,
+            or_(
+                ChangeLog.conversation_id.in_(my_conversations),
+                # Removals from conversations I'm no longer in
+                and_(ChangeLog.user_id == current_user.id, ChangeLog.type.in_(MEMBERSHIP_EVENTS))
+            )
+        )
+        .order_by(ChangeLog.seq)
+        .limit(limit + 1)
+    )).scalars().all())
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    
+    # Each referenced message once, in its current state
+    message_ids = {c.message_id for c in changes if c.type in MESSAGE_EVENTS}
+    messages = []
+    if message_ids:
+        messages = (await db.execute(
+            select(Message).options(selectinload(Message.sender)).where(Message.id.in_(message_ids))
+        )).scalars().all()
+    
+    return SyncResponse(
+        changes=[ChangeResponse.from_orm(c) for c in changes],
+        messages=[MessageResponse.from_orm(m) for m in messages],
+        next_since=changes[-1].seq if changes else since,
+        has_more=has_more
+    )
+
+
+async def prune_change_log(db: AsyncSession) -> int:
+    """Drop changes past the retention window, always keeping the newest so checkpoints stay checkable"""
+    cutoff = datetime.utcnow() - timedelta(hours=CHANGE_LOG_RETENTION_HOURS)
+    result = await db.execute(
+        delete(ChangeLog).where(
+            ChangeLog.created_at < cutoff,
+            ChangeLog.seq > 0,
+            ChangeLog.seq < select(func.max(ChangeLog.seq)).scalar_subquery()
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+
+class ChangeLogPruner:
+    """Background task keeping change_log within CHANGE_LOG_RETENTION_HOURS"""
+    
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _run(self):
+        while True:
+            try:
+                async with AsyncSessionLocal() as db:
+                    pruned = await prune_change_log(db)
+                if pruned:
+                    print(f"Pruned {pruned} change log entries")
+            except Exception as e:
+                print(f"Error pruning change log: {e}")
+            await asyncio.sleep(CHANGE_LOG_PRUNE_INTERVAL)
+
+
+change_log_pruner = ChangeLogPruner()
+
+
+class ChangeLogSequencer:
+    """Numbers committed change_log events and announces them on chat_events.
+    
+    Writers commit events with a provisional negative seq and wake their node's
+    sequencer when the session commits. sequence_chat_events() serialises the
+    sequencers of all nodes, so writers never wait on each other and seqs still
+    appear in order.
+    """
+    
+    def __init__(self):
+        self.connection = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        self._wake = asyncio.Event()
+        self.connection = await asyncpg.connect(ASYNC_DATABASE_URL)
+        event.listen(Session, "after_commit", self._after_commit)
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            event.remove(Session, "after_commit", self._after_commit)
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.connection:
+            await self.connection.close()
+    
+    def _after_commit(self, session):
+        self._wake.set()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), CHANGE_LOG_SEQUENCE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                if self.connection.is_closed():
+                    self.connection = await asyncpg.connect(ASYNC_DATABASE_URL)
+                # Events committed while a batch ran wake us again
+                while await self.connection.fetchval(
+                    "SELECT sequence_chat_events($1)", CHANGE_LOG_SEQUENCE_BATCH
+                ) == CHANGE_LOG_SEQUENCE_BATCH:
+                    pass
+            except Exception as e:
+                print(f"Error sequencing change log: {e}")
+
+
+change_log_sequencer = ChangeLogSequencer()
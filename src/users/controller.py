@@ -1,10 +1,15 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from src.users.models import UserResponse, UserUpdate
-from src.auth.services import get_current_user, save_upload_file
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from src.users.models import UserResponse, UserUpdate, PresenceRequest, PresenceResponse, UserSearchPage
+from src.users.services import search_users
+from src.websocket.presence import presence
+from src.auth.services import get_current_user, save_upload_file, auth_cache, revoke_tokens
+from src.media.services import store_blob, remove_file
 from src.entities.users import User
-from src.database.core import get_db
+from src.database.core import get_async_db
 from datetime import datetime
 
 router = APIRouter(
@@ -14,66 +19,85 @@ router = APIRouter(
 
 
 @router.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: User = Depends(get_current_user)):
     """Get current user info"""
     return current_user
 
-@router.get("/", response_model=List[UserResponse])
-def search_users(query: str = "", limit: int = 20, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Search users"""
+@router.get("/", response_model=UserSearchPage)
+async def search_user(
+    query: str = "",
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Search users by username or display name"""
+    return await search_users(query, limit, cursor, current_user, db)
 
-    users = db.query(User).filter(User.username.contains(query) | User.display_name.contains(query)).filter(User.id != current_user.id).limit(limit).all()
+@router.post("/presence", response_model=List[PresenceResponse])
+async def get_presence(request: PresenceRequest, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
-    return users
-
-@router.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_user)):
-    """Get current user info"""
-    return current_user
+    """Online state of up to 500 users in one call"""
+    if len(request.user_ids) > 500:
+        raise HTTPException(status_code=400, detail="At most 500 users per request")
+    
+    rows = (await db.execute(
+        select(User.id, User.is_online, User.last_seen).where(User.id.in_(request.user_ids))
+    )).all()
+    
+    result = []
+    for user_id, is_online, last_seen in rows:
+        # Users connected to this node are answered from memory; the rest from the
+        # periodically flushed columns, which cover every node, ignoring online
+        # flags that went stale
+        local = presence.get(user_id)
+        if local is not None and local.online:
+            is_online, last_seen = True, local.last_seen
+        else:
+            is_online = bool(is_online) and presence.is_fresh(last_seen)
+        result.append(PresenceResponse(user_id=user_id, is_online=is_online, last_seen=last_seen))
+    return result
 
 @router.patch("/me", response_model=UserResponse)
-def update_user(update: UserUpdate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_user(update: UserUpdate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
     """Update user profile"""
     if update.display_name:
         current_user.display_name = update.display_name
     if update.email:
-        existing = db.query(User).filter(User.email == update.email, User.id != current_user.id).first()
+        existing = await db.scalar(select(User).where(User.email == update.email, User.id != current_user.id))
         if existing:
             raise HTTPException(status_code=400, detail="Email already in use")
         current_user.email = update.email
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    auth_cache.invalidate(current_user.id)
+    await db.refresh(current_user)
     return current_user
 
 @router.post("/me/avatar")
-def upload_avatar(file: UploadFile = File(...), current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def upload_avatar(file: UploadFile = File(...), current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
     """Upload user avatar"""
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    file_path, _ = save_upload_file(file, "avatars")
-    current_user.avatar_url = f"/{file_path}"
-    db.commit()
+    temp_path, file_size, sha256 = await run_in_threadpool(save_upload_file, file)
+    try:
+        current_user.avatar_url, _ = await store_blob(temp_path, sha256, file_size, file.content_type, db)
+        await db.commit()
+        auth_cache.invalidate(current_user.id)
+    finally:
+        await run_in_threadpool(remove_file, temp_path)
     
     return {"avatar_url": current_user.avatar_url}
 
 @router.delete("/me")
-def delete_user_account(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_user_account(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
 
     """Delete user account (soft delete)"""
     current_user.is_active = False
     current_user.deleted_at = datetime.utcnow()
     current_user.is_online = False
-    db.commit()
+    await revoke_tokens(current_user.id, db)
     return {"message": "Account deleted successfully"}
-
-
-@router.get("/", response_model=List[UserResponse])
-def search_users(query: str = "", limit: int = 20, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Search users"""
-    users = db.query(User).filter(User.is_active == True).filter(User.username.contains(query) | User.display_name.contains(query)).filter(User.id != current_user.id).limit(limit).all()
-    
-    return users
\ No newline at end of file
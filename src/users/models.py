@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 from pydantic import BaseModel
 
 class UserResponse(BaseModel):
@@ -16,4 +16,16 @@ class UserResponse(BaseModel):
 
 class UserUpdate(BaseModel):
     display_name: Optional[str] = None
-    email: Optional[str] = None
\ No newline at end of file
+    email: Optional[str] = None
+
+class PresenceRequest(BaseModel):
+    user_ids: List[str]
+
+class PresenceResponse(BaseModel):
+    user_id: str
+    is_online: bool
+    last_seen: Optional[datetime]
+
+class UserSearchPage(BaseModel):
+    users: List[UserResponse]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,171 @@
+from bisect import bisect_left, insort
+from fastapi.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Set, Tuple
+from src.database.core import ASYNC_DATABASE_URL
+import asyncio
+import asyncpg
+import os
+
+
+USER_SEARCH_PREFIX_INDEX = os.getenv("USER_SEARCH_PREFIX_INDEX", "false").lower() == "true"
+USER_CHANGES_CHANNEL = "user_changes"
+PREFIX_INDEX_RETRY_DELAY = 5.0
+
+
+def match_key(rank: int, query: str, username: str, display_name: Optional[str]) -> str:
+    """The lowercased name a user is listed under at `rank` (exact, prefix, substring)"""
+    if rank == 0:
+        return query
+    if rank == 1:
+        return min(name for name in (username, display_name) if name is not None and name.startswith(query))
+    return min(name for name in (username, display_name) if name is not None and query in name)
+
+
+class UserPrefixIndex:
+    """In-process prefix index over usernames and display names, for autocomplete.
+    
+    Every active user's lowercased username and display name are kept in one
+    sorted list, so the first page of a prefix search is a bisect and a short
+    walk instead of a database query. The list is loaded in the background at
+    startup and follows changes through the user_changes channel, which a
+    trigger on users notifies on every node. Searches go to the database until
+    it is loaded. Costs roughly 450 bytes of memory per user.
+    """
+    
+    def __init__(self):
+        self.entries: List[Tuple[str, str]] = []  # Sorted (key, user_id)
+        self.users: Dict[str, Tuple[str, Optional[str]]] = {}  # user_id -> (username, display_name), lowercased
+        self.ready = False
+        self.updates = 0
+        self._pending: Set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._connection = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if not USER_SEARCH_PREFIX_INDEX:
+            return
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._close()
+    
+    async def _close(self):
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
+    
+    async def _run(self):
+        while True:
+            try:
+                self._connection = await asyncpg.connect(ASYNC_DATABASE_URL)
+                # Listen before loading so no change made during the load is missed
+                await self._connection.add_listener(USER_CHANGES_CHANNEL, self._on_change)
+                await self.load(self._connection)
+                print(f"User prefix index loaded ({len(self.users)} users)")
+                while True:
+                    await self._wakeup.wait()
+                    self._wakeup.clear()
+                    await self._refresh(self._connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in user prefix index: {e}")
+                self.ready = False
+                await self._close()
+                await asyncio.sleep(PREFIX_INDEX_RETRY_DELAY)
+    
+    def _on_change(self, conn, pid, channel, payload):
+        self._pending.add(payload)
+        self._wakeup.set()
+    
+    async def load(self, conn):
+        """Rebuild the index from every active user"""
+        self._pending.clear()
+        users = {}
+        async with conn.transaction():
+            async for user_id, username, display_name in conn.cursor(
+                "SELECT id, lower(username), lower(display_name) FROM users WHERE is_active = true", prefetch=10000
+            ):
+                users[user_id] = (username, display_name)
+        self.entries = await run_in_threadpool(self._build, users)
+        self.users = users
+        self.ready = True
+        # Changes that arrived while loading may or may not be in the snapshot
+        await self._refresh(conn)
+    
+    @staticmethod
+    def _build(users: Dict[str, Tuple[str, Optional[str]]]) -> List[Tuple[str, str]]:
+        entries = []
+        for user_id, (username, display_name) in users.items():
+            entries.append((username, user_id))
+            if display_name is not None and display_name != username:
+                entries.append((display_name, user_id))
+        entries.sort()
+        return entries
+    
+    async def _refresh(self, conn):
+        user_ids, self._pending = list(self._pending), set()
+        if not user_ids:
+            return
+        rows = await conn.fetch(
+            "SELECT id, lower(username), lower(display_name) FROM users WHERE id = ANY($1::text[]) AND is_active = true",
+            user_ids
+        )
+        for user_id in user_ids:
+            self.remove(user_id)
+        for user_id, username, display_name in rows:
+            self.add(user_id, username, display_name)
+        self.updates += len(user_ids)
+    
+    def add(self, user_id: str, username: str, display_name: Optional[str]):
+        self.users[user_id] = (username, display_name)
+        insort(self.entries, (username, user_id))
+        if display_name is not None and display_name != username:
+            insort(self.entries, (display_name, user_id))
+    
+    def remove(self, user_id: str):
+        names = self.users.pop(user_id, None)
+        if names is None:
+            return
+        for key in set(names):
+            if key is None:
+                continue
+            position = bisect_left(self.entries, (key, user_id))
+            if position < len(self.entries) and self.entries[position] == (key, user_id):
+                del self.entries[position]
+    
+    def search(self, query: str, limit: int, exclude_id: str) -> List[Tuple[int, str, str]]:
+        """Exact and prefix matches as (rank, key, user_id), in the database's result order.
+        
+        Each user is reported once, under the same rank and key the database
+        search would give it, and always at its first entry in the list, so
+        the walk stays within about twice `limit` entries.
+        """
+        hits = []
+        position = bisect_left(self.entries, (query, ""))
+        while position < len(self.entries) and len(hits) < limit:
+            key, user_id = self.entries[position]
+            position += 1
+            if not key.startswith(query):
+                break
+            username, display_name = self.users[user_id]
+            rank = 0 if query in (username, display_name) else 1
+            if key == match_key(rank, query, username, display_name) and user_id != exclude_id:
+                hits.append((rank, key, user_id))
+        return hits
+    
+    def status(self) -> dict:
+        return {
+            "enabled": USER_SEARCH_PREFIX_INDEX, "ready": self.ready,
+            "users": len(self.users), "entries": len(self.entries), "updates": self.updates
+        }
+
+
+user_prefix_index = UserPrefixIndex()
@@ -0,0 +1,124 @@
+from fastapi import HTTPException
+from sqlalchemy import select, and_, func, tuple_, union_all, collate
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Tuple
+from src.entities.users import User
+from src.users.models import UserResponse, UserSearchPage
+from src.users.prefix_index import user_prefix_index, match_key
+import base64
+import json
+import os
+
+
+# Substring matches need pg_trgm's indexes; without them they scan users
+USER_SEARCH_SUBSTRING = os.getenv("USER_SEARCH_SUBSTRING", "true").lower() == "true"
+SEARCH_RANKS = 3  # Exact, prefix, substring
+SUBSTRING_MIN_LENGTH = 3  # Shortest query the trigram indexes can serve
+PREFIX_END = "\U0010ffff"  # Sorts after any string starting with the prefix
+
+
+def search_key(column):
+    """Lowercased column in byte order, as indexed by idx_users_*_search"""
+    return collate(func.lower(column), "C")
+
+
+def rank_query(rank: int, query: str, after: Optional[Tuple[str, str]], exclude_id: str, limit: int):
+    """(id, key, username, display_name) of the next `limit` name matches of one rank.
+    
+    Each field is an ordered scan of its own index, merged in (key, id) order.
+    Users matching a better rank on either field are left out; users matching
+    this rank on both fields appear twice and are deduplicated by the caller.
+    """
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    fields = []
+    for column in (User.username, User.display_name):
+        key = search_key(column)
+        # Matches at each rank or better
+        fields.append((key, (
+            key == query,
+            and_(key >= query, key < query + PREFIX_END),
+            func.lower(column).like(pattern, escape="\\")
+        )))
+    username_key, display_key = fields[0][0], fields[1][0]
+    
+    branches = []
+    for key, matches in fields:
+        conditions = [matches[rank], User.is_active == True, User.id != exclude_id]
+        if rank > 0:
+            # display_name is nullable and NULL must count as "no match"
+            conditions += [other[rank - 1].is_not(True) for _, other in fields]
+        if key is display_key:
+            conditions.append(display_key != username_key)  # Same name, reported once
+        if after:
+            conditions.append(tuple_(key, User.id) > tuple_(*after))
+        branches.append(
+            select(User.id, key.label("key"), username_key.label("username"), display_key.label("display_name"))
+            .where(*conditions).order_by(key, User.id).limit(limit)
+        )
+    matches = union_all(*branches).subquery()
+    return select(matches).order_by(matches.c.key, matches.c.id).limit(limit)
+
+
+def encode_search_cursor(rank: int, key: str, user_id: str) -> str:
+    """Opaque pagination cursor for a result's (rank, key, id) position"""
+    raw = json.dumps([rank, key, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> Tuple[int, Tuple[str, str]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        rank, key, user_id = json.loads(raw)
+        if rank not in range(SEARCH_RANKS):
+            raise ValueError(rank)
+        return rank, (str(key), str(user_id))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def search_users(query: str, limit: int, cursor: Optional[str], current_user: User, db: AsyncSession) -> UserSearchPage:
+    """Active users matching `query`, case-insensitively.
+    
+    Exact username or display name matches come first, then prefix matches,
+    then (unless disabled, for queries of SUBSTRING_MIN_LENGTH characters or
+    more) substring matches; each group is ordered by the matched name (the first in order
+    when both match). `cursor` continues
+    from the `next_cursor` of a previous page.
+    """
+    query = query.strip().lower()
+    rank, after = decode_search_cursor(cursor) if cursor else (0, None)
+    
+    hits = []
+    if not cursor and user_prefix_index.ready:
+        # The in-process index holds every exact and prefix match
+        hits = user_prefix_index.search(query, limit + 1, current_user.id)
+        rank = 2
+    
+    for current_rank in range(rank, SEARCH_RANKS):
+        if len(hits) > limit or (current_rank == 2 and (not USER_SEARCH_SUBSTRING or len(query) < SUBSTRING_MIN_LENGTH)):
+            break
+        position = after if current_rank == rank else None
+        while len(hits) <= limit:
+            # A user is listed under the first of its matching names; its other
+            # name comes later in the scan and is skipped
+            batch = 2 * (limit + 1 - len(hits))
+            rows = (await db.execute(rank_query(current_rank, query, position, current_user.id, batch))).all()
+            for user_id, key, username, display_name in rows:
+                if key == match_key(current_rank, query, username, display_name):
+                    hits.append((current_rank, key, user_id))
+            if len(rows) < batch:
+                break
+            user_id, key = rows[-1][:2]
+            position = (key, user_id)
+    
+    page = hits[:limit]
+    users = {}
+    if page:
+        users = {user.id: user for user in (await db.execute(
+            select(User).where(User.id.in_([user_id for _, _, user_id in page]), User.is_active == True)
+        )).scalars()}
+    
+    return UserSearchPage(
+        users=[UserResponse.from_orm(users[user_id]) for _, _, user_id in page if user_id in users],
+        next_cursor=encode_search_cursor(*page[-1]) if len(hits) > limit else None
+    )
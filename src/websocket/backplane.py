@@ -0,0 +1,230 @@
+from typing import Dict, Optional, Union
+from src.database.core import ASYNC_DATABASE_URL
+from src.websocket.frames import encode_frame
+import asyncio
+import asyncpg
+import hashlib
+import json
+import os
+import socket
+
+
+WS_BACKPLANE = os.getenv("WS_BACKPLANE", "local")
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Rooms and users are hashed onto this many channels each, bounding how many
+# channels a node LISTENs on however many rooms it hosts
+WS_BACKPLANE_SHARDS = int(os.getenv("WS_BACKPLANE_SHARDS", "256"))
+# NOTIFY payloads are capped at 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+def shard(key: str) -> int:
+    """Stable across processes, unlike hash()"""
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) % WS_BACKPLANE_SHARDS
+
+
+def room_channel(conversation_id: str) -> str:
+    return f"room_{shard(conversation_id)}"
+
+
+def user_channel(user_id: str) -> str:
+    return f"user_{shard(user_id)}"
+
+
+class LocalBackplane:
+    """In-process backplane (the default): events only reach sockets on this node.
+    
+    Node-originated events (typing, presence, ...) are published through the
+    backplane rather than the connection manager so a cluster backplane can carry
+    them to the other nodes. The manager reports rooms and users appearing and
+    disappearing locally, which a cluster backplane uses to subscribe this node
+    to exactly the rooms and users it hosts.
+    """
+    
+    name = "local"
+    
+    def __init__(self, connection_manager):
+        self.manager = connection_manager
+        self.published = 0
+        self.received = 0
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    def room_opened(self, conversation_id: str):
+        pass
+    
+    def room_closed(self, conversation_id: str):
+        pass
+    
+    def user_opened(self, user_id: str):
+        pass
+    
+    def user_closed(self, user_id: str):
+        pass
+    
+    async def publish_to_conversation(self, message: Union[dict, str], conversation_id: str,
+                                      exclude_user: Optional[str] = None, coalesce_key: Optional[str] = None):
+        self.published += 1
+        await self.manager.broadcast_to_conversation(message, conversation_id, exclude_user, coalesce_key)
+    
+    async def publish_to_user(self, message: Union[dict, str], user_id: str, coalesce_key: Optional[str] = None):
+        self.published += 1
+        await self.manager.send_personal_message(message, user_id, coalesce_key)
+    
+    def status(self) -> dict:
+        return {"backplane": self.name, "node_id": NODE_ID, "published": self.published, "received": self.received}
+
+
+class PostgresBackplane(LocalBackplane):
+    """Cluster backplane over Postgres LISTEN/NOTIFY.
+    
+    Rooms and users are hashed onto WS_BACKPLANE_SHARDS channels each. A node
+    LISTENs on the channels of the rooms with local members and of its locally
+    connected users, so Postgres only delivers an event to nodes that host a
+    room or user sharing its channel, and each node drops events without local
+    recipients. Publishing delivers to local sockets directly and NOTIFYs the
+    channel; a node ignores its own notifications.
+    """
+    
+    name = "postgres"
+    
+    def __init__(self, connection_manager):
+        super().__init__(connection_manager)
+        self.connection = None
+        self.pool = None
+        self.channels = set()
+        self.channel_refs: Dict[str, int] = {}  # Local rooms and users per channel
+        self.too_large = 0
+        self.filtered = 0
+        self._changes: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        self.connection = await asyncpg.connect(ASYNC_DATABASE_URL)
+        self.pool = await asyncpg.create_pool(ASYNC_DATABASE_URL, min_size=1, max_size=2)
+        for conversation_id in list(self.manager.conversation_rooms):
+            self.room_opened(conversation_id)
+        for user_id in list(self.manager.active_connections):
+            self.user_opened(user_id)
+        self._task = asyncio.create_task(self._sync_listeners())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.connection:
+            await self.connection.close()
+        if self.pool:
+            await self.pool.close()
+    
+    # LISTEN/UNLISTEN are applied in order by one task, since the manager reports
+    # changes synchronously and a connection runs one command at a time
+    def room_opened(self, conversation_id: str):
+        self._acquire(room_channel(conversation_id))
+    
+    def room_closed(self, conversation_id: str):
+        self._release(room_channel(conversation_id))
+    
+    def user_opened(self, user_id: str):
+        self._acquire(user_channel(user_id))
+    
+    def user_closed(self, user_id: str):
+        self._release(user_channel(user_id))
+    
+    def _acquire(self, channel: str):
+        self.channel_refs[channel] = self.channel_refs.get(channel, 0) + 1
+        if self.channel_refs[channel] == 1:
+            self._changes.put_nowait((True, channel))
+    
+    def _release(self, channel: str):
+        refs = self.channel_refs.get(channel, 0) - 1
+        if refs > 0:
+            self.channel_refs[channel] = refs
+            return
+        self.channel_refs.pop(channel, None)
+        self._changes.put_nowait((False, channel))
+    
+    async def _sync_listeners(self):
+        while True:
+            listen, channel = await self._changes.get()
+            try:
+                if listen and channel not in self.channels:
+                    await self.connection.add_listener(channel, self.on_notify)
+                    self.channels.add(channel)
+                elif not listen and channel in self.channels:
+                    await self.connection.remove_listener(channel, self.on_notify)
+                    self.channels.discard(channel)
+            except Exception as e:
+                print(f"Error updating backplane subscription {channel}: {e}")
+    
+    async def publish_to_conversation(self, message: Union[dict, str], conversation_id: str,
+                                      exclude_user: Optional[str] = None, coalesce_key: Optional[str] = None):
+        await super().publish_to_conversation(message, conversation_id, exclude_user, coalesce_key)
+        await self._notify(room_channel(conversation_id), {
+            "conversation_id": conversation_id, "exclude_user": exclude_user,
+            "coalesce_key": coalesce_key, "message": message
+        })
+    
+    async def publish_to_user(self, message: Union[dict, str], user_id: str, coalesce_key: Optional[str] = None):
+        await super().publish_to_user(message, user_id, coalesce_key)
+        await self._notify(user_channel(user_id), {
+            "user_id": user_id, "coalesce_key": coalesce_key, "message": message
+        })
+    
+    async def _notify(self, channel: str, envelope: dict):
+        envelope["node"] = NODE_ID
+        payload = encode_frame(envelope)
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            self.too_large += 1
+            print(f"Backplane event on {channel} too large for NOTIFY, delivered locally only")
+            return
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+        except Exception as e:
+            print(f"Error publishing to backplane: {e}")
+    
+    def on_notify(self, conn, pid, channel, payload):
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            return
+        if envelope.get("node") == NODE_ID:
+            return
+        # Other rooms and users share the channel
+        if envelope.get("conversation_id") not in self.manager.conversation_rooms \
+                and envelope.get("user_id") not in self.manager.active_connections:
+            self.filtered += 1
+            return
+        self.received += 1
+        asyncio.create_task(self._deliver(envelope))
+    
+    async def _deliver(self, envelope: dict):
+        message = envelope["message"]
+        if "conversation_id" in envelope:
+            await self.manager.broadcast_to_conversation(
+                message, envelope["conversation_id"], envelope.get("exclude_user"), envelope.get("coalesce_key")
+            )
+        else:
+            await self.manager.send_personal_message(message, envelope["user_id"], envelope.get("coalesce_key"))
+    
+    def status(self) -> dict:
+        status = super().status()
+        status.update(channels=len(self.channels), filtered=self.filtered, too_large=self.too_large)
+        return status
+
+
+BACKPLANES = {"local": LocalBackplane, "postgres": PostgresBackplane}
+
+
+def create_backplane(connection_manager) -> LocalBackplane:
+    if WS_BACKPLANE not in BACKPLANES:
+        raise ValueError(f"Unknown WS_BACKPLANE {WS_BACKPLANE!r}, expected one of {', '.join(BACKPLANES)}")
+    return BACKPLANES[WS_BACKPLANE](connection_manager)
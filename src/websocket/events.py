@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from src.entities.message import MessageType
+from src.entities.conversation_participant import ParticipantRole
+from src.websocket.frames import encode_frame
+from sqlalchemy import select, func
+import asyncio
+import json
+import os
+import time
+
+
+EVENT_CHANNEL = "chat_events"
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+USER_FIELDS = "id, username, email, display_name, avatar_url, is_online, last_seen"
+MESSAGE_FIELDS = (
+    "id, conversation_id, sender_id, content, message_type, file_url, file_name, "
+    "is_edited, edited_at, deleted_at, created_at, media"
+)
+
+
+async def publish_event(db, event: dict):
+    """Log an ID-only event and queue it on the chat_events channel; both happen when `db` commits"""
+    extra = {k: v for k, v in event.items() if k not in ("type", "conversation_id", "message_id", "user_id")}
+    await db.execute(select(func.emit_chat_event(
+        event["conversation_id"], event["type"], event.get("message_id"), event.get("user_id"),
+        encode_frame(extra) if extra else None
+    )))
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+    
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def __len__(self):
+        return len(self._data)
+
+
+class EventHydrator:
+    """Turns the ID-only events published on `chat_events` into client payloads.
+    
+    Events are queued as they arrive and processed in bursts: every burst loads
+    the referenced messages with one query and the users it still needs with
+    one more, with users served from a TTL cache where possible.
+    """
+    
+    def __init__(self, connection_manager):
+        self.manager = connection_manager
+        self.pool = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self, pool):
+        self.pool = pool
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    def submit(self, event: dict):
+        self.queue.put_nowait(event)
+    
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < EVENT_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.dispatch(batch)
+            except Exception as e:
+                print(f"Error hydrating events: {e}")
+    
+    async def dispatch(self, events: List[dict]):
+        # Every node hears every event; only hydrate the ones with recipients here
+        events = [e for e in events if e["conversation_id"] in self.manager.conversation_rooms
+                  or e.get("user_id") in self.manager.active_connections
+                  or (e["type"] == "new_message" and self.manager.inbox_users)]
+        if not events:
+            return
+        
+        message_ids = {e["message_id"] for e in events
+                       if e.get("message_id") and e["type"] in ("new_message", "message_edited", "message_deleted")}
+        messages = await self.load_messages(message_ids)
+        
+        user_ids = {m["sender_id"] for m in messages.values()}
+        user_ids |= {e["user_id"] for e in events
+                     if e.get("user_id") and e["type"] == "participant_added"}
+        users = await self.load_users(user_ids)
+        
+        for event in events:
+            await self.deliver(event, messages, users)
+        
+        if self.manager.inbox_users:
+            await self.deliver_inbox(events, messages)
+    
+    async def load_messages(self, message_ids) -> Dict[str, dict]:
+        if not message_ids:
+            return {}
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {MESSAGE_FIELDS} FROM messages WHERE id = ANY($1::varchar[])", list(message_ids)
+            )
+        return {row["id"]: dict(row) for row in rows}
+    
+    async def deliver_inbox(self, events: List[dict], messages: Dict[str, dict]):
+        """Conversation-level summaries for lazily subscribed members not in the room.
+        
+        One summary per conversation per burst, carrying its latest message and
+        the member's unread count.
+        """
+        latest = {}
+        for event in events:
+            message = messages.get(event.get("message_id"))
+            if event["type"] == "new_message" and message:
+                latest[message["conversation_id"]] = message
+        if not latest:
+            return
+        
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT conversation_id, user_id, unread_count FROM conversation_participants "
+                "WHERE conversation_id = ANY($1::varchar[]) AND is_active",
+                list(latest)
+            )
+        
+        for row in rows:
+            conversation_id, user_id = row["conversation_id"], row["user_id"]
+            if user_id not in self.manager.inbox_users:
+                continue
+            message = latest[conversation_id]
+            data = {
+                "conversation_id": conversation_id, "unread_count": row["unread_count"],
+                "last_message": {
+                    "id": message["id"], "sender_id": message["sender_id"], "content": message["content"],
+                    "message_type": MessageType[message["message_type"]].value, "created_at": message["created_at"]
+                }
+            }
+            await self.manager.send_unsubscribed(
+                {"type": "inbox_update", "data": data}, user_id, conversation_id, coalesce_key=f"inbox:{conversation_id}"
+            )
+    
+    async def load_users(self, user_ids) -> Dict[str, dict]:
+        users = {}
+        missing = []
+        for user_id in user_ids:
+            cached = self.users.get(user_id)
+            if cached is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = cached
+        if missing:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    f"SELECT {USER_FIELDS} FROM users WHERE id = ANY($1::varchar[])", missing
+                )
+            for row in rows:
+                user = dict(row)
+                self.users.set(user["id"], user)
+                users[user["id"]] = user
+        return users
+    
+    async def deliver(self, event: dict, messages: Dict[str, dict], users: Dict[str, dict]):
+        event_type = event["type"]
+        conversation_id = event["conversation_id"]
+        seq = event.get("seq")
+        
+        if event_type == "new_message":
+            message = messages.get(event["message_id"])
+            if not message:
+                return
+            data = {
+                "id": message["id"], "conversation_id": message["conversation_id"],
+                "sender_id": message["sender_id"], "content": message["content"],
+                "message_type": MessageType[message["message_type"]].value,
+                "file_url": message["file_url"], "file_name": message["file_name"],
+                "media": json.loads(message["media"]) if message["media"] else None,
+                "created_at": message["created_at"], "sender": users.get(message["sender_id"])
+            }
+            await self.manager.broadcast_to_conversation(
+                {"type": event_type, "seq": seq, "data": data}, conversation_id, exclude_user=message["sender_id"]
+            )
+        
+        elif event_type == "message_edited":
+            message = messages.get(event["message_id"])
+            if not message:
+                return
+            data = {
+                "id": message["id"], "conversation_id": message["conversation_id"],
+                "content": message["content"], "is_edited": message["is_edited"],
+                "edited_at": message["edited_at"]
+            }
+            await self.manager.broadcast_to_conversation({"type": event_type, "seq": seq, "data": data}, conversation_id)
+        
+        elif event_type == "message_deleted":
+            message = messages.get(event["message_id"])
+            data = {
+                "id": event["message_id"], "conversation_id": conversation_id,
+                "deleted_at": message["deleted_at"] if message else None
+            }
+            await self.manager.broadcast_to_conversation({"type": event_type, "seq": seq, "data": data}, conversation_id)
+        
+        elif event_type == "media_ready":
+            data = {"id": event["message_id"], "conversation_id": conversation_id, "media": event.get("media")}
+            await self.manager.broadcast_to_conversation({"type": event_type, "seq": seq, "data": data}, conversation_id)
+        
+        elif event_type == "message_read":
+            data = {
+                "message_id": event["message_id"], "user_id": event["user_id"],
+                "read_at": event.get("read_at"), "read_up_to": event.get("read_up_to"),
+                "conversation_id": conversation_id
+            }
+            await self.manager.broadcast_to_conversation(
+                {"type": event_type, "seq": seq, "data": data}, conversation_id,
+                coalesce_key=f"read:{conversation_id}:{event['user_id']}"
+            )
+        
+        elif event_type == "participant_added":
+            user_id = event["user_id"]
+            data = {
+                "conversation_id": conversation_id, "user_id": user_id, "user": users.get(user_id),
+                "role": ParticipantRole[event["role"]].value if event.get("role") else None
+            }
+            # Route the conversation to the new member right away instead of on their next connect
+            if self.manager.joins_all_conversations(user_id):
+                self.manager.join_conversation(user_id, conversation_id)
+            await self.manager.broadcast_to_conversation({"type": event_type, "seq": seq, "data": data}, conversation_id)
+            await self.manager.send_unsubscribed({"type": event_type, "seq": seq, "data": data}, user_id, conversation_id)
+        
+        elif event_type == "participant_removed":
+            user_id = event["user_id"]
+            data = {"conversation_id": conversation_id, "user_id": user_id}
+            await self.manager.broadcast_to_conversation({"type": event_type, "seq": seq, "data": data}, conversation_id)
+            await self.manager.send_unsubscribed({"type": event_type, "seq": seq, "data": data}, user_id, conversation_id)
+            self.manager.leave_conversation(user_id, conversation_id)
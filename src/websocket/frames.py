@@ -0,0 +1,23 @@
+from typing import Union
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib encoder
+    orjson = None
+
+
+def _default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_frame(message: Union[dict, str]) -> str:
+    """Encode an outbound websocket frame once so it can be shared by every socket"""
+    if isinstance(message, str):
+        return message
+    if orjson is not None:
+        return orjson.dumps(message, default=_default).decode("utf-8")
+    return json.dumps(message, default=_default, separators=(",", ":"))
+
@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from src.entities.presence_session import PresenceSession
+from src.websocket.backplane import NODE_ID
+from src.websocket.websocket_manager import backplane
+import asyncio
+import os
+import time
+
+
+PRESENCE_DEBOUNCE = float(os.getenv("PRESENCE_DEBOUNCE", "5"))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "2"))
+PRESENCE_REFRESH_INTERVAL = float(os.getenv("PRESENCE_REFRESH_INTERVAL", "60"))
+# A DB is_online flag whose last_seen is older than this is treated as offline
+# (e.g. the node holding the socket crashed before flushing)
+PRESENCE_STALE_AFTER = float(os.getenv("PRESENCE_STALE_AFTER", str(PRESENCE_REFRESH_INTERVAL * 3)))
+
+
+class UserPresence:
+    __slots__ = ("online", "announced", "last_seen", "changed_at", "flushed_at")
+    
+    def __init__(self):
+        self.online = False
+        self.announced: Optional[bool] = None
+        self.last_seen = datetime.utcnow()
+        self.changed_at = time.monotonic()
+        self.flushed_at = 0.0
+
+
+class PresenceService:
+    """Online state of the users connected to this node, kept in memory.
+    
+    Connects, disconnects and heartbeats only touch memory. A background task
+    periodically:
+    
+    * records transitions that held for `PRESENCE_DEBOUNCE` seconds as this
+      node's row in presence_sessions, and refreshes the rows of online users
+      every `PRESENCE_REFRESH_INTERVAL`,
+    * derives is_online from the sessions of every node, so a user goes
+      offline only when no node holds a socket of theirs any more,
+    * announces users whose is_online changed, batched into one `presence`
+      event per conversation, so a flapping connection produces no events,
+    * clears sessions and is_online flags that went stale because their node died.
+    """
+    
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.pool = None
+        self.users: Dict[str, UserPresence] = {}
+        self.flushes = 0
+        self.swept_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self, pool):
+        self.pool = pool
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Users still connected here go offline with this node
+        for presence in self.users.values():
+            presence.online = False
+            presence.changed_at = 0.0
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing presence on shutdown: {e}")
+    
+    def connected(self, user_id: str):
+        presence = self.users.get(user_id)
+        if presence is None:
+            presence = self.users[user_id] = UserPresence()
+        if not presence.online:
+            presence.online = True
+            presence.changed_at = time.monotonic()
+        presence.last_seen = datetime.utcnow()
+    
+    def heartbeat(self, user_id: str):
+        presence = self.users.get(user_id)
+        if presence is not None:
+            presence.last_seen = datetime.utcnow()
+    
+    def disconnected(self, user_id: str):
+        """Call when the user's last socket on this node is gone"""
+        presence = self.users.get(user_id)
+        if presence is not None and presence.online:
+            presence.online = False
+            presence.last_seen = datetime.utcnow()
+            presence.changed_at = time.monotonic()
+    
+    def get(self, user_id: str) -> Optional[UserPresence]:
+        return self.users.get(user_id)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing presence: {e}")
+    
+    async def flush(self):
+        now = time.monotonic()
+        settled, refresh = [], []
+        for user_id, p in list(self.users.items()):
+            if p.online != bool(p.announced):
+                if now - p.changed_at >= PRESENCE_DEBOUNCE:
+                    settled.append((user_id, p.online, p.last_seen))
+            elif not p.online:
+                # Came and went within the debounce window: nothing to announce
+                del self.users[user_id]
+            elif now - p.flushed_at >= PRESENCE_REFRESH_INTERVAL:
+                refresh.append((user_id, True, p.last_seen))
+        
+        rows = settled + refresh
+        if rows:
+            changes = await self.store(rows)
+            if changes:
+                await self.announce(changes)
+            self.flushes += 1
+        
+        # State may have moved on while we were awaiting; only record what was written
+        for user_id, online, _ in rows:
+            presence = self.users.get(user_id)
+            if presence is None:
+                continue
+            presence.announced = online
+            presence.flushed_at = now
+            if not online and not presence.online:
+                del self.users[user_id]
+        
+        if now - self.swept_at >= PRESENCE_REFRESH_INTERVAL:
+            self.swept_at = now
+            stale = datetime.utcnow() - timedelta(seconds=PRESENCE_STALE_AFTER)
+            async with self.pool.acquire() as conn:
+                await conn.execute(f"DELETE FROM {PresenceSession.__tablename__} WHERE last_seen < $1", stale)
+                await conn.execute("UPDATE users SET is_online = false WHERE is_online AND last_seen < $1", stale)
+    
+    async def store(self, rows: List[tuple]) -> List[tuple]:
+        """Write this node's sessions and each user's state across all nodes.
+        
+        The users are locked for the transaction, so two nodes dropping a
+        user's last sockets at the same time cannot both still see the other's
+        session. Returns (user_id, is_online, last_seen) of users whose
+        is_online changed.
+        """
+        user_ids = [r[0] for r in rows]
+        online = [r for r in rows if r[1]]
+        offline = [r[0] for r in rows if not r[1]]
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                before = {row["id"]: row["is_online"] for row in await conn.fetch(
+                    "SELECT id, is_online FROM users WHERE id = ANY($1::varchar[]) ORDER BY id FOR UPDATE", user_ids
+                )}
+                if online:
+                    await conn.execute(
+                        f"INSERT INTO {PresenceSession.__tablename__} (user_id, node_id, last_seen) "
+                        "SELECT v.id, $2, v.seen FROM unnest($1::varchar[], $3::timestamp[]) AS v(id, seen) "
+                        "ON CONFLICT (user_id, node_id) DO UPDATE SET last_seen = EXCLUDED.last_seen",
+                        [r[0] for r in online], NODE_ID, [r[2] for r in online]
+                    )
+                if offline:
+                    await conn.execute(
+                        f"DELETE FROM {PresenceSession.__tablename__} WHERE node_id = $1 AND user_id = ANY($2::varchar[])",
+                        NODE_ID, offline
+                    )
+                after = await conn.fetch(
+                    "UPDATE users SET last_seen = GREATEST(users.last_seen, v.seen), is_online = EXISTS ("
+                    f"  SELECT 1 FROM {PresenceSession.__tablename__} s WHERE s.user_id = users.id AND s.last_seen >= $3"
+                    ") FROM unnest($1::varchar[], $2::timestamp[]) AS v(id, seen) "
+                    "WHERE users.id = v.id RETURNING users.id, users.is_online, users.last_seen",
+                    user_ids, [r[2] for r in rows], datetime.utcnow() - timedelta(seconds=PRESENCE_STALE_AFTER)
+                )
+        return [(row["id"], row["is_online"], row["last_seen"]) for row in after
+                if row["is_online"] != before.get(row["id"])]
+    
+    async def announce(self, changes: List[tuple]):
+        """One presence event per affected conversation listing every change in it"""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT conversation_id, user_id FROM conversation_participants "
+                "WHERE user_id = ANY($1::varchar[]) AND is_active",
+                [user_id for user_id, _, _ in changes]
+            )
+        by_user = {user_id: (online, last_seen) for user_id, online, last_seen in changes}
+        per_conversation: Dict[str, List[dict]] = {}
+        for row in rows:
+            online, last_seen = by_user[row["user_id"]]
+            per_conversation.setdefault(row["conversation_id"], []).append({
+                "user_id": row["user_id"], "is_online": online, "last_seen": last_seen
+            })
+        for conversation_id, users in per_conversation.items():
+            await self.publisher.publish_to_conversation(
+                {"type": "presence", "data": {"conversation_id": conversation_id, "users": users}}, conversation_id
+            )
+    
+    def is_fresh(self, last_seen: Optional[datetime]) -> bool:
+        return last_seen is not None and datetime.utcnow() - last_seen < timedelta(seconds=PRESENCE_STALE_AFTER)
+
+
+presence = PresenceService(backplane)
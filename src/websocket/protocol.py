@@ -0,0 +1,192 @@
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Union
+from src.database.core import AsyncSessionLocal
+from src.entities.users import User
+from src.entities.conversation_participant import ConversationParticipant
+from src.message.models import MessageCreate, MessageEdit, MessageResponse, ReadUpToRequest
+from src.message.services import send_messages, edit_messages, delete_messages, mark_conversation_read
+from src.websocket.websocket_manager import manager
+from src.websocket.typing_state import typing_store
+from src.websocket.presence import presence
+import json
+
+
+PROTOCOL_VERSION = 1
+
+
+class ClientFrame(BaseModel):
+    """Envelope of every client -> server frame.
+    
+    `id` is chosen by the client and echoed back in the ack so responses can be
+    matched to requests; frames without an id are fire-and-forget.
+    """
+    v: int = PROTOCOL_VERSION
+    id: Optional[Union[str, int]] = None
+    type: str
+
+
+class SendMessageFrame(BaseModel):
+    conversation_id: str
+    content: str
+    message_type: str = "text"
+
+
+class EditMessageFrame(BaseModel):
+    message_id: str
+    content: str
+
+
+class DeleteMessageFrame(BaseModel):
+    message_id: str
+
+
+class MarkReadFrame(BaseModel):
+    conversation_id: str
+    message_id: str
+
+
+class SubscribeFrame(BaseModel):
+    conversation_id: str
+
+
+class TypingFrame(BaseModel):
+    conversation_id: str
+    is_typing: bool = True
+
+
+class ClientSession:
+    """Per-socket protocol state: the authenticated user, loaded once at connect.
+    
+    Every frame is handled on a short-lived database session with the same
+    service functions the REST endpoints use, so there is no JWT decode, user
+    lookup or HTTP round trip per action.
+    """
+    
+    def __init__(self, websocket, user: User, user_data: dict):
+        self.websocket = websocket
+        self.user = user
+        self.user_data = user_data
+        self.handlers = {
+            "send_message": self.on_send_message,
+            "edit_message": self.on_edit_message,
+            "delete_message": self.on_delete_message,
+            "mark_read": self.on_mark_read,
+            "typing": self.on_typing,
+            "subscribe": self.on_subscribe,
+            "unsubscribe": self.on_unsubscribe
+        }
+    
+    async def handle(self, data: str):
+        """Handle one client frame; malformed frames without an id are ignored"""
+        try:
+            raw = json.loads(data)
+            frame = ClientFrame.model_validate(raw)
+        except (ValueError, ValidationError):
+            return
+        
+        # Every frame counts as a heartbeat; ping exists for otherwise idle clients
+        presence.heartbeat(self.user.id)
+        if frame.type == "ping":
+            writer = manager.writer_for(self.websocket, self.user.id)
+            if writer:
+                writer.heartbeats = True
+            manager.send_to_socket({"type": "pong", "id": frame.id}, self.websocket, self.user.id)
+            return
+        if frame.type == "pong":
+            return
+        
+        try:
+            if frame.v != PROTOCOL_VERSION:
+                raise HTTPException(status_code=400, detail=f"Unsupported protocol version {frame.v}")
+            handler = self.handlers.get(frame.type)
+            if handler is None:
+                raise HTTPException(status_code=400, detail=f"Unknown frame type {frame.type}")
+            result = await handler(raw)
+        except HTTPException as e:
+            await self.reply(frame.id, error={"status": e.status_code, "detail": e.detail})
+        except ValidationError as e:
+            await self.reply(frame.id, error={"status": 422, "detail": jsonable_encoder(e.errors(include_url=False))})
+        except Exception as e:
+            print(f"Error handling {frame.type} frame from user {self.user.id}: {e}")
+            await self.reply(frame.id, error={"status": 500, "detail": "Internal error"})
+        else:
+            await self.reply(frame.id, data=result)
+    
+    async def reply(self, request_id: Optional[Union[str, int]], data=None, error: Optional[dict] = None):
+        if request_id is None:
+            return
+        ack = {"type": "ack", "id": request_id, "ok": error is None}
+        if error is None:
+            ack["data"] = jsonable_encoder(data)
+        else:
+            ack["error"] = error
+        manager.send_to_socket(ack, self.websocket, self.user.id)
+    
+    async def on_send_message(self, raw: dict):
+        frame = SendMessageFrame.model_validate(raw)
+        async with AsyncSessionLocal() as db:
+            message = await send_messages(MessageCreate(**frame.dict()), self.user, db)
+            return MessageResponse.from_orm(message)
+    
+    async def on_edit_message(self, raw: dict):
+        frame = EditMessageFrame.model_validate(raw)
+        async with AsyncSessionLocal() as db:
+            message = await edit_messages(frame.message_id, MessageEdit(content=frame.content), self.user, db)
+            return MessageResponse.from_orm(message)
+    
+    async def on_delete_message(self, raw: dict):
+        frame = DeleteMessageFrame.model_validate(raw)
+        async with AsyncSessionLocal() as db:
+            return await delete_messages(frame.message_id, self.user, db)
+    
+    async def on_mark_read(self, raw: dict):
+        frame = MarkReadFrame.model_validate(raw)
+        async with AsyncSessionLocal() as db:
+            return await mark_conversation_read(
+                frame.conversation_id, ReadUpToRequest(message_id=frame.message_id), self.user, db
+            )
+    
+    async def check_participant(self, conversation_id: str):
+        async with AsyncSessionLocal() as db:
+            participant = await db.scalar(
+                select(ConversationParticipant.id).where(
+                    ConversationParticipant.conversation_id == conversation_id,
+                    ConversationParticipant.user_id == self.user.id,
+                    ConversationParticipant.is_active == True
+                )
+            )
+        if not participant:
+            raise HTTPException(status_code=403, detail="Not a participant")
+    
+    async def on_typing(self, raw: dict):
+        frame = TypingFrame.model_validate(raw)
+        # Joined rooms skip the database round trip, but inbox sockets only join the
+        # conversations they subscribed to, so anything else is looked up
+        if self.user.id not in manager.conversation_rooms.get(frame.conversation_id, ()):
+            await self.check_participant(frame.conversation_id)
+        await typing_store.set_typing(frame.conversation_id, self.user.id, frame.is_typing, self.user_data)
+        return None
+    
+    async def on_subscribe(self, raw: dict):
+        """Start receiving every event of a conversation the client has opened"""
+        frame = SubscribeFrame.model_validate(raw)
+        await self.check_participant(frame.conversation_id)
+        writer = manager.writer_for(self.websocket, self.user.id)
+        if writer:
+            manager.subscribe(writer, frame.conversation_id)
+        return None
+    
+    async def on_unsubscribe(self, raw: dict):
+        """Back to inbox summaries only for a conversation the client has closed.
+        
+        Only affects this socket; the user's other sockets keep what they follow.
+        """
+        frame = SubscribeFrame.model_validate(raw)
+        writer = manager.writer_for(self.websocket, self.user.id)
+        if writer:
+            manager.unsubscribe(writer, frame.conversation_id)
+        return None
+
@@ -0,0 +1,86 @@
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import os
+import time
+from src.websocket.websocket_manager import backplane
+
+
+TYPING_TTL = float(os.getenv("TYPING_TTL", "6"))
+TYPING_DEBOUNCE = float(os.getenv("TYPING_DEBOUNCE", "2"))
+TYPING_SWEEP_INTERVAL = float(os.getenv("TYPING_SWEEP_INTERVAL", "1"))
+
+
+class TypingStore:
+    """Ephemeral per-process typing state, never persisted.
+    
+    Every (conversation, user) pair expires `ttl` seconds after its last "typing"
+    signal, so clients only need to repeat it while the user keeps typing. A
+    repeat within `debounce` seconds only extends the expiry and is not fanned
+    out again. Expired and stopped pairs are announced with is_typing false.
+    """
+    
+    def __init__(self, publisher, ttl: float = TYPING_TTL, debounce: float = TYPING_DEBOUNCE):
+        self.publisher = publisher
+        self.ttl = ttl
+        self.debounce = debounce
+        # (conversation_id, user_id) -> [expires_at, last_broadcast_at, user]
+        self.typing: Dict[Tuple[str, str], List] = {}
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def set_typing(self, conversation_id: str, user_id: str, is_typing: bool, user: Optional[dict] = None):
+        key = (conversation_id, user_id)
+        now = time.monotonic()
+        
+        if not is_typing:
+            if self.typing.pop(key, None) is not None:
+                await self.broadcast(conversation_id, user_id, False, user)
+            return
+        
+        state = self.typing.get(key)
+        if state is not None and now - state[1] < self.debounce:
+            state[0] = now + self.ttl
+            return
+        
+        self.typing[key] = [now + self.ttl, now, user]
+        await self.broadcast(conversation_id, user_id, True, user)
+    
+    async def clear_user(self, user_id: str):
+        """Stop every typing state of a user, e.g. when their last socket closes"""
+        for key in [k for k in self.typing if k[1] == user_id]:
+            _, _, user = self.typing.pop(key)
+            await self.broadcast(key[0], user_id, False, user)
+    
+    async def expire(self):
+        now = time.monotonic()
+        for key in [k for k, state in self.typing.items() if state[0] <= now]:
+            _, _, user = self.typing.pop(key)
+            await self.broadcast(key[0], key[1], False, user)
+    
+    async def broadcast(self, conversation_id: str, user_id: str, is_typing: bool, user: Optional[dict]):
+        data = {"conversation_id": conversation_id, "user_id": user_id, "user": user, "is_typing": is_typing}
+        await self.publisher.publish_to_conversation(
+            {"type": "typing_indicator", "data": data}, conversation_id,
+            exclude_user=user_id, coalesce_key=f"typing:{conversation_id}:{user_id}"
+        )
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TYPING_SWEEP_INTERVAL)
+            try:
+                await self.expire()
+            except Exception as e:
+                print(f"Error expiring typing indicators: {e}")
+
+
+typing_store = TypingStore(backplane)
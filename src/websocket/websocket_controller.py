@@ -1,55 +1,73 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
-from datetime import datetime
-from src.auth.services import decode_token
-from src.database.core import get_db
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from sqlalchemy import select
+import asyncio
+import os
+import time
+from src.auth.services import auth_cache
+from src.database.core import AsyncSessionLocal
 from src.entities.users import User
 from src.websocket.websocket_manager import manager
-from src.entities.conversation import Conversation
+from src.websocket.typing_state import typing_store
+from src.websocket.presence import presence
+from src.websocket.protocol import ClientSession
+from src.users.models import UserResponse
 from src.entities.conversation_participant import ConversationParticipant
 
 router = APIRouter()
 
+# "all" joins every conversation at connect; "lazy" joins only what the client
+# subscribes to and sends inbox summaries for the rest
+WS_SUBSCRIPTION_MODE = os.getenv("WS_SUBSCRIPTION_MODE", "all")
 
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, token: str, subscription: str = WS_SUBSCRIPTION_MODE):
     """WebSocket for real-time messaging"""
-    user_id = decode_token(token)
-    if not user_id:
+    claims = auth_cache.claims(token)
+    if not claims or subscription not in ("all", "lazy"):
         await websocket.close(code=1008)
         return
+    user_id, token_version = claims
+    lazy = subscription == "lazy"
     
-    user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-    if not user:
-        await websocket.close(code=1008)
-        return
+    # Sessions are only held while querying, never for the lifetime of the socket
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.id == user_id, User.is_active == True))
+        if not user or user.token_version != token_version:
+            await websocket.close(code=1008)
+            return
+        
+        conversation_ids = [] if lazy else (await db.execute(
+            select(ConversationParticipant.conversation_id)
+            .where(ConversationParticipant.user_id == user_id, ConversationParticipant.is_active == True)
+        )).scalars().all()
     
-    await manager.connect(websocket, user_id)
+    session = ClientSession(websocket, user, UserResponse.from_orm(user).dict())
     
-    user.is_online = True
-    user.last_seen = datetime.utcnow()
-    db.commit()
+    writer = await manager.connect(websocket, user_id, inbox=lazy, token_version=token_version)
+    presence.connected(user_id)
     
     # Join all conversations
-    conversations = db.query(ConversationParticipant)\
-        .filter(ConversationParticipant.user_id == user_id, ConversationParticipant.is_active == True)\
-        .all()
-    
-    for cp in conversations:
-        manager.join_conversation(user_id, cp.conversation_id)
+    for conversation_id in conversation_ids:
+        manager.join_conversation(user_id, conversation_id)
     
     try:
         while True:
             data = await websocket.receive_text()
-            # Handle pings or other client messages
+            writer.last_activity = time.monotonic()
+            await session.handle(data)
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user_id)
-        user.is_online = False
-        user.last_seen = datetime.utcnow()
-        db.commit()
+        await close_connection(websocket, user_id)
+    except asyncio.CancelledError:
+        # The server closed the socket (idle, too slow or failed sends)
+        await close_connection(websocket, user_id)
     except Exception as e:
         print(f"WebSocket error: {e}")
-        manager.disconnect(websocket, user_id)
-        user.is_online = False
-        db.commit()
\ No newline at end of file
+        await close_connection(websocket, user_id)
+
+
+async def close_connection(websocket: WebSocket, user_id: str):
+    manager.disconnect(websocket, user_id)
+    if user_id not in manager.active_connections:
+        presence.disconnected(user_id)
+        await typing_store.clear_user(user_id)
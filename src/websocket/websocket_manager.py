@@ -1,59 +1,351 @@
 from fastapi import WebSocket
-from typing import  Dict, Set, Optional
+from typing import  Deque, Dict, List, Set, Optional, Union
+from collections import deque
+from enum import Enum
+from src.auth.services import auth_cache
 from src.database.core import ASYNC_DATABASE_URL
+from src.websocket.frames import encode_frame
+from src.websocket.events import EventHydrator, EVENT_CHANNEL
+from src.websocket.backplane import create_backplane
+from src.users.prefix_index import USER_CHANGES_CHANNEL
+import asyncio
 import asyncpg
 import json
+import os
+import sys
+import time
 
 
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+# Dead peers are found by the server's protocol-level pings (uvicorn's
+# --ws-ping-interval / --ws-ping-timeout). Sockets that opted in to app-level
+# heartbeats by sending a ping frame are also pinged after WS_PING_INTERVAL
+# seconds of silence and reaped after WS_IDLE_TIMEOUT; the reaper runs every
+# WS_REAP_INTERVAL
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "75"))
+WS_REAP_INTERVAL = float(os.getenv("WS_REAP_INTERVAL", "10"))
+PING_FRAME = encode_frame({"type": "ping"})
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class SocketWriter:
+    """Bounded outbound queue drained by a dedicated writer task for one websocket.
+    
+    Broadcasting only enqueues pre-encoded text frames, so a slow client never
+    delays delivery to the rest of the room. When the queue is full the overflow policy decides what
+    happens: drop the oldest frame, coalesce frames sharing a key (falling back
+    to drop oldest), or disconnect the slow consumer.
+    """
+    
+    def __init__(self, websocket: WebSocket, user_id: str, on_close, max_queue: int = WS_SEND_QUEUE_SIZE,
+                 policy: OverflowPolicy = OverflowPolicy(WS_OVERFLOW_POLICY)):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue: Deque[List] = deque()
+        self.pending_keys: Dict[str, List] = {}
+        self.dropped = 0
+        self.closed = False
+        self.close_reason = "client"
+        self.inbox = False
+        # Conversations a lazily subscribed socket has opened
+        self.subscriptions: Set[str] = set()
+        self.last_activity = time.monotonic()
+        self.pinged_at = 0.0
+        self.heartbeats = False  # Set once the client sends an app-level ping
+        self.token_version = 0  # Of the token the socket authenticated with
+        # The task reading from this socket, cancelled when the server closes it
+        self.reader: Optional[asyncio.Task] = None
+        self._on_close = on_close
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def follows(self, conversation_id: str) -> bool:
+        """Whether this socket receives every event of the conversation"""
+        return not self.inbox or conversation_id in self.subscriptions
+    
+    def enqueue(self, frame: str, coalesce_key: Optional[str] = None) -> bool:
+        if self.closed:
+            return False
+        
+        if coalesce_key is not None and self.policy == OverflowPolicy.COALESCE:
+            entry = self.pending_keys.get(coalesce_key)
+            if entry is not None:
+                entry[1] = frame
+                return True
+        
+        if len(self.queue) >= self.max_queue:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                print(f"User {self.user_id} socket too slow, disconnecting")
+                self.close_reason = "slow"
+                self.close(code=1013)
+                return False
+            self._pop()
+            self.dropped += 1
+        
+        entry = [coalesce_key, frame]
+        self.queue.append(entry)
+        if coalesce_key is not None:
+            self.pending_keys[coalesce_key] = entry
+        self._wakeup.set()
+        return True
+    
+    def _pop(self) -> List:
+        entry = self.queue.popleft()
+        if entry[0] is not None and self.pending_keys.get(entry[0]) is entry:
+            del self.pending_keys[entry[0]]
+        return entry
+    
+    def close(self, code: Optional[int] = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.pending_keys.clear()
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._on_close(self)
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+            # A half-open peer never completes the close handshake, so stop waiting for it
+            if self.reader and self.reader is not asyncio.current_task():
+                self.reader.cancel()
+    
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+    
+    async def _run(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, frame = self._pop()
+                await asyncio.wait_for(self.websocket.send_text(frame), WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Send to user {self.user_id} failed: {e}")
+            self.close_reason = "send_failed"
+            self.close(code=1013 if isinstance(e, asyncio.TimeoutError) else None)
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.active_connections: Dict[str, Dict[WebSocket, SocketWriter]] = {}
         self.conversation_rooms: Dict[str, Set[str]] = {}
+        # Reverse index of conversation_rooms, so a user's rooms are found without a scan
+        self.user_rooms: Dict[str, Set[str]] = {}
+        self.backplane = None
+        self.connection_count = 0
+        self.opened = 0
+        self.closed_by_reason: Dict[str, int] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        # Users with lazily subscribed sockets -> number of such sockets; they get
+        # inbox summaries for conversations they have not subscribed to
+        self.inbox_users: Dict[str, int] = {}
     
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str, inbox: bool = False,
+                      token_version: int = 0) -> SocketWriter:
         await websocket.accept()
         if user_id not in self.active_connections:
-            self.active_connections[user_id] = set()
-        self.active_connections[user_id].add(websocket)
-        print(f"User {user_id} connected. Active: {sum(len(c) for c in self.active_connections.values())}")
+            self.active_connections[user_id] = {}
+            self.backplane.user_opened(user_id)
+        writer = SocketWriter(websocket, user_id, on_close=self._discard_writer)
+        writer.inbox = inbox
+        writer.token_version = token_version
+        if inbox:
+            self.inbox_users[user_id] = self.inbox_users.get(user_id, 0) + 1
+        self.active_connections[user_id][websocket] = writer
+        writer.reader = asyncio.current_task()
+        self.connection_count += 1
+        self.opened += 1
+        writer.start()
+        print(f"User {user_id} connected. Active: {self.connection_count}")
+        return writer
     
     def disconnect(self, websocket: WebSocket, user_id: str):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].discard(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-                for room_users in self.conversation_rooms.values():
-                    room_users.discard(user_id)
+        writer = self.active_connections.get(user_id, {}).get(websocket)
+        if writer:
+            writer.close()
         print(f"User {user_id} disconnected")
     
+    def _discard_writer(self, writer: SocketWriter):
+        connections = self.active_connections.get(writer.user_id)
+        if not connections or connections.get(writer.websocket) is not writer:
+            return
+        del connections[writer.websocket]
+        self.connection_count -= 1
+        self.closed_by_reason[writer.close_reason] = self.closed_by_reason.get(writer.close_reason, 0) + 1
+        if writer.inbox:
+            self.inbox_users[writer.user_id] -= 1
+            if not self.inbox_users[writer.user_id]:
+                del self.inbox_users[writer.user_id]
+        if not connections:
+            del self.active_connections[writer.user_id]
+            self.backplane.user_closed(writer.user_id)
+            for conversation_id in list(self.user_rooms.get(writer.user_id, ())):
+                self.leave_conversation(writer.user_id, conversation_id)
+        elif not writer.inbox or writer.subscriptions:
+            # Keep only the rooms the user's remaining sockets still follow
+            for conversation_id in list(self.user_rooms.get(writer.user_id, ())):
+                if not self.follows(writer.user_id, conversation_id):
+                    self.leave_conversation(writer.user_id, conversation_id)
+    
+    def start_reaper(self):
+        self._reaper = asyncio.create_task(self._reap_forever())
+    
+    async def stop_reaper(self):
+        if self._reaper:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+    
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(WS_REAP_INTERVAL)
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Error reaping websockets: {e}")
+    
+    def reap(self):
+        """Ping quiet heartbeating sockets and close the ones that stayed silent past the idle timeout.
+        
+        Clients that never sent a ping may not answer one, so they are left to
+        protocol-level pings.
+        """
+        now = time.monotonic()
+        for connections in list(self.active_connections.values()):
+            for writer in list(connections.values()):
+                if not writer.heartbeats:
+                    continue
+                idle = now - writer.last_activity
+                if idle >= WS_IDLE_TIMEOUT:
+                    print(f"User {writer.user_id} socket idle for {idle:.0f}s, reaping")
+                    writer.close_reason = "idle"
+                    writer.close(code=1001)
+                elif idle >= WS_PING_INTERVAL and now - writer.pinged_at >= WS_PING_INTERVAL:
+                    writer.pinged_at = now
+                    writer.enqueue(PING_FRAME)
+    
+    def stats(self) -> dict:
+        return {
+            "connections": self.connection_count,
+            "users": len(self.active_connections),
+            "rooms": len(self.conversation_rooms),
+            "queued_frames": sum(len(w.queue) for c in self.active_connections.values() for w in c.values()),
+            "opened_total": self.opened,
+            "closed_total": dict(self.closed_by_reason)
+        }
+    
+    def close_revoked(self, user_id: str, token_version: Optional[int]):
+        """Close the user's sockets whose token is no longer valid (None: account gone)"""
+        for writer in list(self.active_connections.get(user_id, {}).values()):
+            if token_version is None or writer.token_version != token_version:
+                print(f"User {user_id} token revoked, closing socket")
+                writer.close_reason = "revoked"
+                writer.close(code=1008)
+    
+    def joins_all_conversations(self, user_id: str) -> bool:
+        """Whether the user has a socket here that follows every conversation (not lazy)"""
+        return len(self.active_connections.get(user_id, ())) > self.inbox_users.get(user_id, 0)
+    
+    def follows(self, user_id: str, conversation_id: str) -> bool:
+        """Whether any socket of the user here receives every event of the conversation"""
+        return any(w.follows(conversation_id) for w in self.active_connections.get(user_id, {}).values())
+    
+    def subscribe(self, writer: SocketWriter, conversation_id: str):
+        """Route a conversation to one lazily subscribed socket"""
+        writer.subscriptions.add(sys.intern(conversation_id))
+        self.join_conversation(writer.user_id, conversation_id)
+    
+    def unsubscribe(self, writer: SocketWriter, conversation_id: str):
+        writer.subscriptions.discard(conversation_id)
+        if not self.follows(writer.user_id, conversation_id):
+            self.leave_conversation(writer.user_id, conversation_id)
+    
     def join_conversation(self, user_id: str, conversation_id: str):
+        # Interned so the same ID string is shared by every room and index entry
+        user_id, conversation_id = sys.intern(user_id), sys.intern(conversation_id)
         if conversation_id not in self.conversation_rooms:
             self.conversation_rooms[conversation_id] = set()
+            self.backplane.room_opened(conversation_id)
         self.conversation_rooms[conversation_id].add(user_id)
+        self.user_rooms.setdefault(user_id, set()).add(conversation_id)
     
     def leave_conversation(self, user_id: str, conversation_id: str):
-        if conversation_id in self.conversation_rooms:
-            self.conversation_rooms[conversation_id].discard(user_id)
-    
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            disconnected = set()
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    disconnected.add(connection)
-            for conn in disconnected:
-                self.active_connections[user_id].discard(conn)
-    
-    async def broadcast_to_conversation(self, message: dict, conversation_id: str, exclude_user: Optional[str] = None):
-        if conversation_id in self.conversation_rooms:
-            for user_id in self.conversation_rooms[conversation_id]:
-                if user_id != exclude_user:
-                    await self.send_personal_message(message, user_id)
+        for writer in self.active_connections.get(user_id, {}).values():
+            writer.subscriptions.discard(conversation_id)
+        rooms = self.user_rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(conversation_id)
+            if not rooms:
+                del self.user_rooms[user_id]
+        
+        room = self.conversation_rooms.get(conversation_id)
+        if room is None:
+            return
+        room.discard(user_id)
+        if not room:
+            del self.conversation_rooms[conversation_id]
+            self.backplane.room_closed(conversation_id)
+    
+    def _enqueue(self, frame: str, user_id: str, coalesce_key: Optional[str] = None,
+                 conversation_id: Optional[str] = None):
+        for writer in list(self.active_connections.get(user_id, {}).values()):
+            if conversation_id is None or writer.follows(conversation_id):
+                writer.enqueue(frame, coalesce_key)
+    
+    def writer_for(self, websocket: WebSocket, user_id: str) -> Optional[SocketWriter]:
+        return self.active_connections.get(user_id, {}).get(websocket)
+    
+    def send_to_socket(self, message: Union[dict, str], websocket: WebSocket, user_id: str):
+        writer = self.writer_for(websocket, user_id)
+        if writer:
+            writer.enqueue(encode_frame(message))
+    
+    async def send_personal_message(self, message: Union[dict, str], user_id: str, coalesce_key: Optional[str] = None):
+        self._enqueue(encode_frame(message), user_id, coalesce_key)
+    
+    async def send_unsubscribed(self, message: Union[dict, str], user_id: str, conversation_id: str,
+                                coalesce_key: Optional[str] = None):
+        """To the user's sockets that do not follow the conversation"""
+        frame = None
+        for writer in list(self.active_connections.get(user_id, {}).values()):
+            if not writer.follows(conversation_id):
+                frame = frame or encode_frame(message)
+                writer.enqueue(frame, coalesce_key)
+    
+    async def broadcast_to_conversation(self, message: Union[dict, str], conversation_id: str,
+                                        exclude_user: Optional[str] = None, coalesce_key: Optional[str] = None):
+        room = self.conversation_rooms.get(conversation_id)
+        if not room:
+            return
+        frame = encode_frame(message)
+        for user_id in list(room):
+            if user_id != exclude_user:
+                self._enqueue(frame, user_id, coalesce_key, conversation_id)
 
 manager = ConnectionManager()
+backplane = manager.backplane = create_backplane(manager)
 
 
 
@@ -61,94 +353,46 @@ manager = ConnectionManager()
 class PostgresNotifier:
     def __init__(self):
         self.connection = None
+        self.pool = None
         self.listening = False
+        self.hydrator = EventHydrator(manager)
     
     async def connect(self):
         self.connection = await asyncpg.connect(ASYNC_DATABASE_URL)
-        await self.connection.add_listener('new_message', self.message_callback)
-        await self.connection.add_listener('message_edited', self.edit_callback)
-        await self.connection.add_listener('message_deleted', self.delete_callback)
-        await self.connection.add_listener('typing_indicator', self.typing_callback)
-        await self.connection.add_listener('message_read', self.read_receipt_callback)
-        await self.connection.add_listener('participant_added', self.participant_added_callback)
-        await self.connection.add_listener('participant_removed', self.participant_removed_callback)
+        self.pool = await asyncpg.create_pool(ASYNC_DATABASE_URL, min_size=1, max_size=2)
+        self.hydrator.start(self.pool)
+        await self.connection.add_listener(EVENT_CHANNEL, self.event_callback)
+        await self.connection.add_listener(USER_CHANGES_CHANNEL, self.user_callback)
         self.listening = True
         print("PostgreSQL LISTEN started")
     
-    async def message_callback(self, conn, pid, channel, payload):
+    def event_callback(self, conn, pid, channel, payload):
         try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "new_message", "data": data},
-                data.get('conversation_id'),
-                exclude_user=data.get('sender_id')
-            )
+            self.hydrator.submit(json.loads(payload))
         except Exception as e:
             print(f"Error: {e}")
     
-    async def edit_callback(self, conn, pid, channel, payload):
-        try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "message_edited", "data": data},
-                data.get('conversation_id')
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-    
-    async def delete_callback(self, conn, pid, channel, payload):
-        try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "message_deleted", "data": data},
-                data.get('conversation_id')
-            )
-        except Exception as e:
-            print(f"Error: {e}")
+    def user_callback(self, conn, pid, channel, payload):
+        """A user changed on some node: drop its snapshot here and check its open sockets"""
+        auth_cache.invalidate(payload)
+        if payload in manager.active_connections:
+            asyncio.create_task(self.check_tokens(payload))
     
-    async def typing_callback(self, conn, pid, channel, payload):
+    async def check_tokens(self, user_id: str):
         try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "typing_indicator", "data": data},
-                data.get('conversation_id'),
-                exclude_user=data.get('user_id')
-            )
+            async with self.pool.acquire() as conn:
+                token_version = await conn.fetchval(
+                    "SELECT token_version FROM users WHERE id = $1 AND is_active", user_id
+                )
+            manager.close_revoked(user_id, token_version)
         except Exception as e:
-            print(f"Error: {e}")
-    
-    async def read_receipt_callback(self, conn, pid, channel, payload):
-        try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "message_read", "data": data},
-                data.get('conversation_id')
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-    
-    async def participant_added_callback(self, conn, pid, channel, payload):
-        try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "participant_added", "data": data},
-                data.get('conversation_id')
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-    
-    async def participant_removed_callback(self, conn, pid, channel, payload):
-        try:
-            data = json.loads(payload)
-            await manager.broadcast_to_conversation(
-                {"type": "participant_removed", "data": data},
-                data.get('conversation_id')
-            )
-        except Exception as e:
-            print(f"Error: {e}")
+            print(f"Error checking tokens of user {user_id}: {e}")
     
     async def close(self):
+        await self.hydrator.stop()
         if self.connection:
             await self.connection.close()
+        if self.pool:
+            await self.pool.close()
 
 postgres_notifier = PostgresNotifier()
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""The inbox is built with a fixed number of queries, however many conversations it shows.
+
+Needs DATABASE_URL / ASYNC_DATABASE_URL pointing at a PostgreSQL database;
+skipped otherwise. The rows it seeds are removed afterwards.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+if not os.getenv("ASYNC_DATABASE_URL"):
+    pytest.skip("ASYNC_DATABASE_URL is not set", allow_module_level=True)
+
+from sqlalchemy import delete, event, select  # noqa: E402
+
+from src.database.core import AsyncSessionLocal, Base, async_engine  # noqa: E402
+from src.entities.users import User  # noqa: E402
+from src.entities.conversation import Conversation  # noqa: E402
+from src.entities.conversation_participant import ConversationParticipant  # noqa: E402
+from src.entities.message import Message  # noqa: E402
+from src.entities.message_read_receipt import MessageReadReceipt  # noqa: E402,F401
+from src.conversation.services import get_conversation_responses  # noqa: E402
+
+
+CONVERSATIONS = 30
+MEMBERS = 3
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+async def seed(db):
+    suffix = uuid.uuid4().hex[:8]
+    users = [
+        User(username=f"test_{suffix}_{i}", email=f"test_{suffix}_{i}@example.com", hashed_password="x")
+        for i in range(MEMBERS)
+    ]
+    db.add_all(users)
+    await db.flush()
+    start = datetime.utcnow() - timedelta(hours=1)
+    conversations = []
+    for i in range(CONVERSATIONS):
+        conversation = Conversation(name=f"test {i}", is_group=True, created_by=users[0].id)
+        db.add(conversation)
+        await db.flush()
+        db.add_all(ConversationParticipant(conversation_id=conversation.id, user_id=u.id) for u in users)
+        db.add_all(
+            Message(conversation_id=conversation.id, sender_id=users[j % MEMBERS].id,
+                    content=f"message {j}", created_at=start + timedelta(seconds=j))
+            for j in range(3)
+        )
+        conversations.append(conversation)
+    await db.commit()
+    return users, conversations
+
+
+async def cleanup(db, users, conversations):
+    conversation_ids = [c.id for c in conversations]
+    await db.execute(delete(Message).where(Message.conversation_id.in_(conversation_ids)))
+    await db.execute(delete(ConversationParticipant).where(ConversationParticipant.conversation_id.in_(conversation_ids)))
+    await db.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids)))
+    await db.execute(delete(User).where(User.id.in_([u.id for u in users])))
+    await db.commit()
+
+
+async def inbox_query_counts(sizes):
+    try:
+        async with async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    except OSError as e:
+        pytest.skip(f"database unavailable: {e}")
+
+    counter = QueryCounter()
+    try:
+        async with AsyncSessionLocal() as db:
+            users, conversations = await seed(db)
+            try:
+                counts = {}
+                for size in sizes:
+                    page = (await db.execute(
+                        select(Conversation).where(Conversation.id.in_([c.id for c in conversations[:size]]))
+                    )).scalars().all()
+                    event.listen(async_engine.sync_engine, "before_cursor_execute", counter.on_execute)
+                    before = counter.count
+                    responses = await get_conversation_responses(page, users[0].id, db)
+                    counts[size] = counter.count - before
+                    event.remove(async_engine.sync_engine, "before_cursor_execute", counter.on_execute)
+                    assert len(responses) == size
+                    assert all(r.last_message is not None and len(r.participants) == MEMBERS for r in responses)
+                return counts
+            finally:
+                await cleanup(db, users, conversations)
+    finally:
+        await async_engine.dispose()
+
+
+def test_inbox_query_count_does_not_grow_with_conversations():
+    counts = asyncio.run(inbox_query_counts([3, CONVERSATIONS]))
+    assert counts[3] == counts[CONVERSATIONS] == 3, counts